@@ -1,6 +1,6 @@
 import json
 
-def get_narrative_analysis_system_prompt(maturity: str, theme: str, audio_type: bool) -> str:
+def get_narrative_analysis_system_prompt(maturity: str, theme: str, audio_type: bool, scaffold: dict = None) -> str:
     """
     Stage 1: Analyzes audio/text input to define the 'Story Bible'.
     
@@ -30,18 +30,32 @@ def get_narrative_analysis_system_prompt(maturity: str, theme: str, audio_type:
         "setting_signature": "A reusable description of the main setting (e.g., 'magical glowing forest with purple trees')."
     }
 
+    # With pre-generated art direction the style is already decided: don't spend output tokens re-deciding it
+    if scaffold and scaffold.get("art_style"):
+        del base_json_structure["art_style"]
+
     if audio_type:
         base_json_structure["transcript"] = "The verbatim transcript of the audio. If silent/unclear, state '[Audio Unclear]'."
 
     json_schema_str = json.dumps(base_json_structure, indent=4)
 
+    # Pre-generated art direction for this theme/maturity (see pregeneration.py)
+    art_direction = ""
+    if scaffold:
+        art_direction = f"""
+    PRE-APPROVED ART DIRECTION:
+    - Art Style (fixed, do not output it): {scaffold.get('art_style', '')}
+    - Suggested Setting (adapt it if the story takes place elsewhere): {scaffold.get('setting_signature', '')}
+    - Mood: {scaffold.get('mood', '')}
+    """
+
     sys_prompt = f"""
     You are an elite Children's Book Editor and Art Director.
     
     INPUT CONTEXT:
     - Target Audience: {maturity} ({guideline})
     - Core Theme: {theme}
-    
+    {art_direction}
     YOUR MISSION:
     1. {"LISTEN & TRANSCRIBE: First, accurately transcribe the user's audio." if audio_type else "READ: Analyze the user's text prompt."}
     2. ANALYZE & FILL GAPS: 
@@ -51,7 +65,7 @@ def get_narrative_analysis_system_prompt(maturity: str, theme: str, audio_type:
     
     3. CREATE THE 'STORY BIBLE':
        - Define a **Visual Signature**: A specific, unchanging description of the protagonist to ensure they look exactly the same on every page.
-       - Define an **Art Style**: Choose a style that fits the mood (e.g., 'Soft Pastel' for Bedtime, 'High Contrast Comic' for Action).
+       {"- Define an **Art Style**: Choose a style that fits the mood (e.g., 'Soft Pastel' for Bedtime, 'High Contrast Comic' for Action)." if "art_style" in base_json_structure else ""}
     
     OUTPUT FORMAT:
     Return ONLY a valid JSON object. Do not include markdown formatting (like ```json).
@@ -156,4 +170,67 @@ def get_image_generation_prompt_rewrite_system_prompt(previous_failures = []) ->
     
     OUTPUT:
     Return ONLY the rewritten prompt string. Do not add "Here is the prompt" or any explanations.
-    """
\ No newline at end of file
+    """
+
+def get_page_text_rewrite_prompt(analysis_json: dict, page_texts: list[dict], page_number: int, instructions: str = None) -> str:
+    """
+    Page regeneration (text only): rewrites a single page of a finished story.
+    
+    - Reuses the Story Bible from Stage 1 so tone and characters stay consistent.
+    - Shows the neighbouring pages so the rewrite still flows.
+    """
+    title = analysis_json.get("title", "Untitled Story")
+    summary = analysis_json.get("plot_summary", "")
+    character = analysis_json.get("character_desc", "")
+    story_so_far = "\n".join(f"Page {p['page_number']}: {p['text_content']}" for p in page_texts)
+    extra = f"\n    USER REQUEST FOR THIS PAGE: {instructions}\n" if instructions else ""
+
+    return f"""
+    You are a professional Children's Book Author revising one page of a finished book.
+    
+    PROJECT: "{title}"
+    SUMMARY: {summary}
+    MAIN CHARACTER: {character}
+    
+    FULL STORY:
+    {story_so_far}
+    {extra}
+    TASK:
+    Rewrite ONLY the text of Page {page_number}.
+    - Keep the same reading level, tone and length as the other pages.
+    - It must still connect naturally to the previous and next pages.
+    - Do not mention page numbers.
+    
+    OUTPUT:
+    Return ONLY the new page text. No quotes, no labels, no explanations.
+    """
+
+def get_story_bible_scaffold_prompt(theme: str, maturity: str) -> str:
+    """
+    Pre-generation: art direction for a popular theme/maturity pair, made ahead of time.
+    
+    - Only the parts of the Story Bible that don't depend on the user's story.
+    - Feeds get_narrative_analysis_system_prompt(scaffold=...) for matching requests,
+      which then no longer generates the art style.
+    """
+    return f"""
+    You are an elite Children's Book Art Director preparing art direction in advance.
+    
+    INPUT CONTEXT:
+    - Target Audience: {maturity}
+    - Core Theme: {theme}
+    
+    TASK:
+    Propose a fresh, cohesive art direction that suits any story with this theme and audience.
+    Do NOT invent characters or plot.
+    
+    OUTPUT FORMAT:
+    Return ONLY a valid JSON object. Do not include markdown formatting (like ```json).
+    
+    JSON STRUCTURE:
+    {{
+        "art_style": "A specific, cohesive art style description",
+        "setting_signature": "A reusable description of a setting that fits the theme",
+        "mood": "The emotional tone and color palette in a few words"
+    }}
+    """
@@ -0,0 +1,149 @@
+import asyncio
+import shutil
+import subprocess
+import numpy as np
+from process_pool import LazyProcessPool
+
+# Speech-friendly output: mono 16kHz Opus in an Ogg container (Gemini accepts audio/ogg)
+SAMPLE_RATE = 16000
+OUTPUT_MIME_TYPE = "audio/ogg"
+OPUS_BITRATE = "24k"
+
+# Silence detection (20ms frames)
+FRAME_SECONDS = 0.02
+SILENCE_FLOOR_DB = -50.0    # Anything quieter is always silence
+DYNAMIC_RANGE_DB = 40.0     # Frames this far below the loudest frame count as silence
+EDGE_PADDING_SECONDS = 0.2  # Kept around the first/last voiced frame
+MAX_GAP_SECONDS = 0.7       # Internal silences longer than this get shortened...
+KEPT_GAP_SECONDS = 0.3      # ...down to this
+
+FFMPEG_TIMEOUT = 60
+
+# Decoding/encoding runs in its own processes so it never blocks the event loop
+audio_pool = LazyProcessPool(max_workers=2)
+
+def _run_ffmpeg(args: list[str], input_bytes: bytes) -> bytes:
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", *args],
+        input=input_bytes,
+        capture_output=True,
+        timeout=FFMPEG_TIMEOUT,
+        check=True,
+    )
+    return result.stdout
+
+def decode_to_mono(audio_bytes: bytes) -> np.ndarray:
+    """Decodes any container/codec ffmpeg understands into mono float32 PCM at SAMPLE_RATE"""
+    raw = _run_ffmpeg(
+        ["-i", "pipe:0", "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "f32le", "pipe:1"],
+        audio_bytes,
+    )
+    return np.frombuffer(raw, dtype=np.float32)
+
+def encode_speech(samples: np.ndarray) -> bytes:
+    return _run_ffmpeg(
+        [
+            "-f", "f32le", "-ar", str(SAMPLE_RATE), "-ac", "1", "-i", "pipe:0",
+            "-c:a", "libopus", "-b:a", OPUS_BITRATE, "-application", "voip",
+            "-f", "ogg", "pipe:1",
+        ],
+        samples.astype(np.float32).tobytes(),
+    )
+
+def trim_silence(samples: np.ndarray, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    Energy-based silence trimming.
+    1. Frame-level RMS in dBFS (vectorized over all frames at once)
+    2. Drops leading/trailing silence (keeping a little padding)
+    3. Shortens long internal pauses to KEPT_GAP_SECONDS
+    """
+    frame_len = int(sample_rate * FRAME_SECONDS)
+    n_frames = len(samples) // frame_len
+    if n_frames == 0:
+        return samples
+
+    frames = samples[:n_frames * frame_len].reshape(n_frames, frame_len)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    db = 20 * np.log10(rms + 1e-10)
+    threshold = max(SILENCE_FLOOR_DB, db.max() - DYNAMIC_RANGE_DB)
+    voiced = db > threshold
+
+    voiced_idx = np.flatnonzero(voiced)
+    if voiced_idx.size == 0:
+        # All silence: let the model decide what to do with it (see the "[Audio Unclear]" prompt path)
+        return samples
+
+    pad = int(EDGE_PADDING_SECONDS / FRAME_SECONDS)
+    first = max(0, voiced_idx[0] - pad)
+    last = min(n_frames, voiced_idx[-1] + pad + 1)
+    keep = np.zeros(n_frames, dtype=bool)
+    keep[first:last] = True
+
+    # Find runs of silent frames inside the kept window
+    inner = voiced[first:last].astype(np.int8)
+    edges = np.diff(np.concatenate(([1], inner, [1])))
+    gap_starts = np.flatnonzero(edges == -1) + first
+    gap_ends = np.flatnonzero(edges == 1) + first
+
+    max_gap = int(MAX_GAP_SECONDS / FRAME_SECONDS)
+    half_kept = int(KEPT_GAP_SECONDS / FRAME_SECONDS) // 2
+    long_gaps = (gap_ends - gap_starts) > max_gap
+    for start, end in zip(gap_starts[long_gaps], gap_ends[long_gaps]):
+        keep[start + half_kept:end - half_kept] = False
+
+    return frames[keep].reshape(-1)
+
+def _unprocessed(audio_bytes: bytes, mime_type: str) -> dict:
+    return {
+        "audio_bytes": audio_bytes,
+        "mime_type": mime_type,
+        "original_bytes": len(audio_bytes),
+        "processed_bytes": len(audio_bytes),
+        "original_seconds": None,
+        "processed_seconds": None,
+        "preprocessed": False,
+    }
+
+def preprocess_audio(audio_bytes: bytes, mime_type: str = "audio/webm") -> dict:
+    """
+    Decodes, trims, downmixes and re-encodes a recording for the model + storage.
+    Runs inside the process pool. Falls back to the original bytes if ffmpeg is
+    missing or fails, so preprocessing never blocks story creation.
+    """
+    stats = _unprocessed(audio_bytes, mime_type)
+    if shutil.which("ffmpeg") is None:
+        print("⚠️ ffmpeg not found, sending original audio.")
+        return stats
+
+    try:
+        samples = decode_to_mono(audio_bytes)
+        trimmed = trim_silence(samples)
+        encoded = encode_speech(trimmed)
+    except Exception as e:
+        print(f"⚠️ Audio preprocessing failed, sending original audio: {e}")
+        return stats
+
+    stats["original_seconds"] = round(len(samples) / SAMPLE_RATE, 2)
+    stats["processed_seconds"] = round(len(trimmed) / SAMPLE_RATE, 2)
+    if len(encoded) >= len(audio_bytes):
+        # Already compact (e.g. a short, clean clip): keep the original
+        return stats
+
+    stats.update({
+        "audio_bytes": encoded,
+        "mime_type": OUTPUT_MIME_TYPE,
+        "processed_bytes": len(encoded),
+        "preprocessed": True,
+    })
+    return stats
+
+async def preprocess_audio_async(audio_bytes: bytes, mime_type: str = "audio/webm") -> dict:
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(audio_pool.get(), preprocess_audio, audio_bytes, mime_type)
+    except Exception as e:
+        # The pool itself failed (worker killed, forkserver didn't start...): preprocess_audio
+        # handles its own errors, so anything here is the executor. Rebuild it on the next request.
+        print(f"⚠️ Audio worker pool failed, sending original audio: {e!r}")
+        audio_pool.reset()
+        return _unprocessed(audio_bytes, mime_type)
@@ -0,0 +1,88 @@
+"""
+Benchmark for the similar-story index (story_index.py).
+
+Builds an index of random embeddings in a temp directory, then measures:
+- Build: per-story incremental append throughput
+- Load: reopening the index from disk (memory-mapped)
+- Query: top-k cosine search latency percentiles
+
+Usage:
+    python bench_story_index.py --stories 300000 --dim 768 --queries 200
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+os.environ.setdefault("STORY_INDEX_DIR", tempfile.gettempdir())
+from story_index import StoryIndex
+
+def percentile_ms(samples: list[float], pct: float) -> float:
+    return round(float(np.percentile(samples, pct)) * 1000, 2)
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark story index build and query latency.")
+    parser.add_argument("--stories", type=int, default=300_000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--incremental", type=int, default=1000,
+                        help="How many of the stories to add one by one (the rest are bulk-written)")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        index = StoryIndex(directory)
+
+        # Bulk part: write the file the same way add() does, just in one go
+        bulk = max(0, args.stories - args.incremental)
+        start = time.perf_counter()
+        if bulk:
+            vectors = rng.standard_normal((bulk, args.dim), dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            index.add("story-0", vectors[0])
+            with open(index.vectors_path, "ab") as file:
+                file.write(vectors[1:].tobytes())
+            with open(index.ids_path, "a") as file:
+                file.write("".join(f"story-{i}\n" for i in range(1, bulk)))
+            del vectors
+        bulk_seconds = time.perf_counter() - start
+
+        # Reopen (what a restarted backend does)
+        start = time.perf_counter()
+        index = StoryIndex(directory)
+        load_seconds = time.perf_counter() - start
+
+        # Incremental part: the real per-story path
+        start = time.perf_counter()
+        for i in range(bulk, args.stories):
+            index.add(f"story-{i}", rng.standard_normal(args.dim, dtype=np.float32))
+        incremental_seconds = time.perf_counter() - start
+
+        # Warm up the page cache, then time queries
+        index.search(rng.standard_normal(args.dim, dtype=np.float32), args.k)
+        timings = []
+        for _ in range(args.queries):
+            query = rng.standard_normal(args.dim, dtype=np.float32)
+            start = time.perf_counter()
+            index.search(query, args.k)
+            timings.append(time.perf_counter() - start)
+
+        size_mb = os.path.getsize(index.vectors_path) / 1e6
+
+    print(f"Index: {len(index)} stories x {args.dim} dims ({size_mb:.0f} MB on disk)")
+    print(f"Bulk write:  {bulk} stories in {bulk_seconds:.2f}s")
+    print(f"Load:        {load_seconds * 1000:.1f}ms")
+    if args.stories > bulk:
+        per_add = incremental_seconds / (args.stories - bulk) * 1000
+        print(f"Incremental: {args.stories - bulk} adds, {per_add:.3f}ms per story")
+    print(
+        f"Query top-{args.k}: p50={percentile_ms(timings, 50)}ms "
+        f"p95={percentile_ms(timings, 95)}ms p99={percentile_ms(timings, 99)}ms"
+    )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
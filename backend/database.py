@@ -1,12 +1,62 @@
 import os
-from pymongo import MongoClient
+import json
+import zlib
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReplaceOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from bson.binary import Binary
 from datetime import datetime, timezone
 from init_env import MONGO_URI
 
 # Initialize Client
 client = MongoClient(MONGO_URI)
 db = client.get_database("storyteller_db")
+
+# Storage layout:
+# - stories:       light document (status, title, progress, history log, page refs)
+# - story_pages:   one document per page, keyed by "<story_id>:<page_number>"
+# - story_context: narrative analysis + storyboard, zlib-compressed JSON
 stories_collection = db.get_collection("stories")
+story_pages_collection = db.get_collection("story_pages")
+story_context_collection = db.get_collection("story_context")
+# Fingerprints of in-flight story requests (single-flight dedup), keyed by fingerprint
+story_inflight_collection = db.get_collection("story_inflight")
+INFLIGHT_TTL_SECONDS = 3600
+# Service-wide counters shared by every worker, keyed by name (e.g. "dedup")
+counters_collection = db.get_collection("counters")
+# Speculatively pre-generated assets for popular (theme, maturity) pairs + daily spend/hit/waste counters
+pregen_assets_collection = db.get_collection("pregen_assets")
+pregen_budget_collection = db.get_collection("pregen_budget")
+
+# Fields that live on the light `stories` document
+STORY_FIELDS = (
+    "status", "progress", "current_stage_message", "title",
+    "creation_metadata", "timestamp", "page_numbers", "cover_image_url", "model_tiers",
+    "pregenerated", "exports", "export_job",
+)
+
+# Projection for the polling endpoint: everything except the legacy embedded context
+STORY_PROJECTION = {"creation_process_context": 0}
+
+# Projection for the history list: just enough to render a card
+HISTORY_PROJECTION = {
+    "title": 1,
+    "status": 1,
+    "progress": 1,
+    "current_stage_message": 1,
+    "creation_metadata": 1,
+    "cover_image_url": 1,
+    "timestamp": 1,
+    "status_history": {"$slice": 1},
+    "pages": {"$slice": 1},  # Legacy documents with embedded pages
+}
+
+def ensure_indexes():
+    """Creates the indexes the projection-based reads rely on. Safe to call repeatedly."""
+    story_pages_collection.create_index([("story_id", ASCENDING), ("page_number", ASCENDING)])
+    stories_collection.create_index([("timestamp", DESCENDING)])
+    # Safety net: claims left behind by crashed workers expire on their own
+    story_inflight_collection.create_index("created_at", expireAfterSeconds=INFLIGHT_TTL_SECONDS)
+    pregen_assets_collection.create_index([("combo", ASCENDING), ("created_at", ASCENDING)])
 
 def serialize_story(story: dict) -> dict:
     """Helper to fix MongoDB's _id object for JSON"""
@@ -15,19 +65,166 @@ def serialize_story(story: dict) -> dict:
         del story["_id"]
     return story
 
+def _pack(value) -> Binary:
+    """Compresses a JSON-serializable value for storage in story_context"""
+    return Binary(zlib.compress(json.dumps(value, default=str).encode("utf-8"), 6))
+
+def _unpack(value):
+    if isinstance(value, (bytes, Binary)):
+        return json.loads(zlib.decompress(value).decode("utf-8"))
+    return value
+
+def _page_doc(story_id: str, page: dict) -> dict:
+    doc = dict(page)
+    doc["_id"] = f"{story_id}:{page['page_number']}"
+    doc["story_id"] = story_id
+    return doc
+
 def save_story(story_id: str, data: dict):
-    """Upserts the story (Create or Update)"""
-    # We use the UUID as the MongoDB _id
-    data["_id"] = story_id
-    stories_collection.replace_one({"_id": story_id}, data, upsert=True)
+    """
+    Upserts the story (Create or Update).
+    Splits the payload across the three collections so only the light fields
+    are written to the `stories` document.
+    """
+    fields = {k: v for k, v in data.items() if k in STORY_FIELDS or k == "status_history"}
+    fields.setdefault("timestamp", datetime.now(timezone.utc))
+    stories_collection.update_one({"_id": story_id}, {"$set": fields}, upsert=True)
+
+    if data.get("pages"):
+        save_pages(story_id, data["pages"])
+    if data.get("creation_process_context"):
+        save_context(story_id, **data["creation_process_context"])
+
+def update_story_fields(story_id: str, fields: dict):
+    """Targeted $set of light fields on the story document"""
+    stories_collection.update_one({"_id": story_id}, {"$set": fields})
+
+def save_pages(story_id: str, pages: list[dict]):
+    """Upserts page documents and records the page refs on the story"""
+    if not pages:
+        return
+    story_pages_collection.bulk_write(
+        [ReplaceOne({"_id": f"{story_id}:{p['page_number']}"}, _page_doc(story_id, p), upsert=True) for p in pages],
+        ordered=False,
+    )
+    page_numbers = sorted(p["page_number"] for p in pages)
+    data_to_set = {"page_numbers": page_numbers}
+    cover = next((p for p in pages if p["page_number"] == page_numbers[0]), None)
+    if cover and cover.get("image_url"):
+        data_to_set["cover_image_url"] = cover["image_url"]
+    stories_collection.update_one({"_id": story_id}, {"$set": data_to_set})
 
-def get_story(story_id: str):
-    doc = stories_collection.find_one({"_id": story_id})
+def get_pages(story_id: str) -> list[dict]:
+    cursor = story_pages_collection.find(
+        {"story_id": story_id}, {"_id": 0, "story_id": 0}
+    ).sort("page_number", ASCENDING)
+    pages = list(cursor)
+    if not pages:
+        # Legacy documents with embedded pages
+        legacy = stories_collection.find_one({"_id": story_id}, {"pages": 1})
+        pages = (legacy or {}).get("pages") or []
+    return pages
+
+def get_page(story_id: str, page_number: int):
+    page = story_pages_collection.find_one({"_id": f"{story_id}:{page_number}"}, {"_id": 0, "story_id": 0})
+    if page is None:
+        # Legacy documents with embedded pages
+        legacy = stories_collection.find_one(
+            {"_id": story_id, "pages.page_number": page_number}, {"pages.$": 1}
+        )
+        page = legacy["pages"][0] if legacy else None
+    return page
+
+def update_page(story_id: str, page: dict):
+    """Replaces a single page in place (and the cover image if it's the first page)"""
+    legacy = stories_collection.find_one(
+        {"_id": story_id, "pages.page_number": page["page_number"]}, {"_id": 1}
+    )
+    if legacy:
+        stories_collection.update_one(
+            {"_id": story_id},
+            {"$set": {"pages.$[p]": page}},
+            array_filters=[{"p.page_number": page["page_number"]}],
+        )
+        return
+    story_pages_collection.replace_one({"_id": f"{story_id}:{page['page_number']}"}, _page_doc(story_id, page), upsert=True)
+    story = get_story_fields(story_id, "page_numbers") or {}
+    page_numbers = story.get("page_numbers") or []
+    if page_numbers and page["page_number"] == page_numbers[0] and page.get("image_url"):
+        stories_collection.update_one({"_id": story_id}, {"$set": {"cover_image_url": page["image_url"]}})
+
+def save_context(story_id: str, **context):
+    """
+    Stores creation context (e.g. narrative_analysis, storyboard_pages) compressed,
+    one field per key so each stage only writes what it produced.
+    """
+    if not context:
+        return
+    story_context_collection.update_one(
+        {"_id": story_id},
+        {"$set": {key: _pack(value) for key, value in context.items()}},
+        upsert=True,
+    )
+
+def get_context(story_id: str, *keys: str) -> dict:
+    """Loads (and decompresses) the creation context, optionally only the given keys"""
+    projection = {key: 1 for key in keys} if keys else None
+    doc = story_context_collection.find_one({"_id": story_id}, projection)
+    if doc is None:
+        # Legacy documents kept the context embedded in the story
+        legacy = stories_collection.find_one({"_id": story_id}, {"creation_process_context": 1})
+        context = (legacy or {}).get("creation_process_context") or {}
+        return {k: v for k, v in context.items() if not keys or k in keys}
+    doc.pop("_id", None)
+    return {key: _unpack(value) for key, value in doc.items()}
+
+def get_story(story_id: str, include_pages: bool = True):
+    doc = stories_collection.find_one({"_id": story_id}, STORY_PROJECTION)
+    if doc is None:
+        return None
+    # Pages are only fetched once they exist (never while the frontend polls an in-progress story)
+    if include_pages and doc.get("page_numbers") and "pages" not in doc:
+        doc["pages"] = get_pages(story_id)
+    doc.setdefault("pages", [])
+    return serialize_story(doc)
+
+def get_story_fields(story_id: str, *fields: str):
+    """Fetches only the given light fields of a story"""
+    return stories_collection.find_one({"_id": story_id}, {field: 1 for field in fields})
+
+def _history_card(doc: dict) -> dict:
+    cover = doc.pop("cover_image_url", None)
+    if cover and not doc.get("pages"):
+        doc["pages"] = [{"page_number": 1, "image_url": cover}]
+    doc.setdefault("pages", [])
     return serialize_story(doc)
 
 def get_all_stories():
-    cursor = stories_collection.find().sort("timestamp", -1) # Optional: sort by time
-    return [serialize_story(doc) for doc in cursor]
+    cursor = stories_collection.find({}, HISTORY_PROJECTION).sort("timestamp", -1)
+    return [_history_card(doc) for doc in cursor]
+
+def get_stories_by_ids(story_ids: list[str]) -> list[dict]:
+    """History cards for just these stories (e.g. search results)"""
+    if not story_ids:
+        return []
+    cursor = stories_collection.find({"_id": {"$in": story_ids}}, HISTORY_PROJECTION)
+    return [_history_card(doc) for doc in cursor]
+
+def append_status_log(story_id: str, message: str):
+    """
+    Adds a history entry without touching the story's current status (e.g. page fixes on a finished story).
+    The entry is logged under the current stage, which may be completed or failed.
+    """
+    story = get_story_fields(story_id, "status", "progress") or {}
+    stories_collection.update_one(
+        {"_id": story_id},
+        {"$push": {"status_history": {
+            "stage": story.get("status", "completed"),
+            "message": message,
+            "progress": story.get("progress", 0),
+            "timestamp": datetime.now(timezone.utc)
+        }}}
+    )
 
 def update_status(story_id: str, stage: str, progress: int, message: str):
     """
@@ -43,7 +240,7 @@ def update_status(story_id: str, stage: str, progress: int, message: str):
         new_log_entry["progress"] = progress
     else:
         # Fetch current progress if not provided
-        story = get_story(story_id)
+        story = get_story_fields(story_id, "progress") or {}
         new_log_entry["progress"] = story.get("progress", 0)
 
     data_to_set = {
@@ -63,4 +260,122 @@ def update_status(story_id: str, stage: str, progress: int, message: str):
                 "status_history": new_log_entry
             }
         }
-    )
\ No newline at end of file
+    )
+
+def claim_fingerprint(fingerprint: str, story_id: str, force: bool = False):
+    """
+    Atomically claims a request fingerprint for story_id.
+    Returns None when the claim succeeded, otherwise the story_id already holding it.
+    """
+    claim = {"_id": fingerprint, "story_id": story_id, "created_at": datetime.now(timezone.utc)}
+    if force:
+        story_inflight_collection.replace_one({"_id": fingerprint}, claim, upsert=True)
+        return None
+    try:
+        story_inflight_collection.insert_one(claim)
+        return None
+    except DuplicateKeyError:
+        existing = story_inflight_collection.find_one({"_id": fingerprint}, {"story_id": 1})
+        if existing is None:
+            # Released between our insert and read: try again
+            return claim_fingerprint(fingerprint, story_id)
+        return existing["story_id"]
+
+def release_fingerprint(fingerprint: str, story_id: str):
+    """Releases the claim, but only if story_id still holds it"""
+    story_inflight_collection.delete_one({"_id": fingerprint, "story_id": story_id})
+
+def increment_counters(name: str, counts: dict):
+    counters_collection.update_one({"_id": name}, {"$inc": counts}, upsert=True)
+
+def get_counters(name: str) -> dict:
+    doc = counters_collection.find_one({"_id": name}, {"_id": 0})
+    return doc or {}
+
+def start_export_attempt(story_id: str) -> int:
+    """Marks the export as rendering and counts the attempt; returns the attempt number"""
+    doc = stories_collection.find_one_and_update(
+        {"_id": story_id},
+        {
+            "$set": {"export_job.status": "rendering", "export_job.updated_at": datetime.now(timezone.utc)},
+            "$inc": {"export_job.attempts": 1},
+        },
+        projection={"export_job.attempts": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    return doc["export_job"]["attempts"] if doc else 0
+
+def iter_pending_exports(max_attempts: int):
+    """Ids of completed stories whose export was queued or interrupted mid-render, under the attempt limit"""
+    cursor = stories_collection.find(
+        {
+            "status": "completed",
+            "export_job.status": {"$in": ["queued", "rendering"]},
+            "$or": [
+                {"export_job.attempts": {"$lt": max_attempts}},
+                {"export_job.attempts": {"$exists": False}},
+            ],
+        },
+        {"_id": 1}
+    ).batch_size(500)
+    for doc in cursor:
+        yield doc["_id"]
+
+def get_stories_without_exports(after_id: str = None, limit: int = 500) -> list[str]:
+    """One page (by _id) of completed stories that never had an export, for the backfill script"""
+    query = {"status": "completed", "exports": {"$exists": False}, "export_job": {"$exists": False}}
+    if after_id is not None:
+        query["_id"] = {"$gt": after_id}
+    cursor = stories_collection.find(query, {"_id": 1}).sort("_id", ASCENDING).limit(limit)
+    return [doc["_id"] for doc in cursor]
+
+# --- Pre-generation (see pregeneration.py) ---
+
+def get_popular_combos(since: datetime, limit: int) -> list[dict]:
+    """Most requested (theme, maturity) pairs since a date: [{"theme", "maturity", "count"}]"""
+    pipeline = [
+        {"$match": {"timestamp": {"$gte": since}}},
+        {"$group": {
+            "_id": {"theme": "$creation_metadata.theme", "maturity": "$creation_metadata.maturity"},
+            "count": {"$sum": 1},
+        }},
+        {"$sort": {"count": -1}},
+        {"$limit": limit},
+    ]
+    return [
+        {"theme": row["_id"]["theme"], "maturity": row["_id"]["maturity"], "count": row["count"]}
+        for row in stories_collection.aggregate(pipeline)
+        if row["_id"].get("theme") and row["_id"].get("maturity")
+    ]
+
+def count_pregen_assets(combo: str) -> int:
+    return pregen_assets_collection.count_documents({"combo": combo})
+
+def save_pregen_asset(combo: str, asset: dict):
+    pregen_assets_collection.insert_one(dict(asset, combo=combo, created_at=datetime.now(timezone.utc)))
+
+def take_pregen_asset(combo: str):
+    """Atomically hands the oldest asset for a combo to one request (assets are single-use)"""
+    return pregen_assets_collection.find_one_and_delete({"combo": combo}, sort=[("created_at", ASCENDING)])
+
+def expire_pregen_assets(before: datetime) -> int:
+    """Drops unused assets older than `before`; returns how many were wasted"""
+    return pregen_assets_collection.delete_many({"created_at": {"$lt": before}}).deleted_count
+
+def spend_pregen_budget(day: str, calls: int) -> int:
+    """Records model calls spent on pre-generation for a UTC day; returns the day's total"""
+    doc = pregen_budget_collection.find_one_and_update(
+        {"_id": day}, {"$inc": {"calls": calls}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return doc["calls"]
+
+def get_pregen_spend(day: str) -> int:
+    doc = pregen_budget_collection.find_one({"_id": day}, {"calls": 1})
+    return doc.get("calls", 0) if doc else 0
+
+def record_pregen_stats(day: str, counts: dict):
+    """Increments a UTC day's hit/miss/generated/wasted counters (kept next to its spend)"""
+    pregen_budget_collection.update_one({"_id": day}, {"$inc": counts}, upsert=True)
+
+def get_pregen_stats() -> list[dict]:
+    return list(pregen_budget_collection.find({}))
@@ -0,0 +1,328 @@
+import io
+import json
+import html
+import uuid
+import zipfile
+import textwrap
+import threading
+import concurrent.futures
+from datetime import datetime, timezone
+import requests
+from PIL import Image, ImageDraw, ImageFont
+
+from database import (
+    get_story, update_story_fields, start_export_attempt, iter_pending_exports, get_stories_without_exports
+)
+from utils import upload_file_bytes, read_file_bytes, delete_file
+from process_pool import LazyProcessPool
+
+EXPORT_FORMATS = {
+    "zip": "application/zip",
+    "epub": "application/epub+zip",
+    "pdf": "application/pdf",
+}
+
+IMAGE_MAX_SIZE = 1024
+JPEG_QUALITY = 82
+PDF_TEXT_FONT_SIZE = 28
+IMAGE_FETCH_TIMEOUT = 30
+# Interrupted exports are resumed on startup at most this many times (a story that kills the renderer can't loop forever)
+MAX_EXPORT_ATTEMPTS = 3
+
+# Rendering is CPU-bound (image re-encoding, PDF layout): keep it in its own processes.
+# The single export thread queues stories so exports never compete with generation for threads.
+# The queue is in memory only: export_job in Mongo is the source of truth, see resume_pending_exports.
+render_pool = LazyProcessPool(max_workers=2)
+_export_queue = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+_stopping = threading.Event()
+
+# --- RENDERING (runs in the process pool) ---
+
+def _optimize_image(image_bytes: bytes) -> bytes | None:
+    try:
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    except Exception:
+        return None
+    image.thumbnail((IMAGE_MAX_SIZE, IMAGE_MAX_SIZE))
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue()
+
+def _page_xhtml(title: str, page: dict, has_image: bool) -> str:
+    image = f'<img src="images/page-{page["page_number"]}.jpg" alt="Illustration"/>' if has_image else ""
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>{html.escape(title)} - Page {page["page_number"]}</title></head>
+<body>
+{image}
+<p>{html.escape(page.get("text_content", ""))}</p>
+</body>
+</html>"""
+
+def _build_epub(story: dict, images: dict[int, bytes]) -> bytes:
+    title = story.get("title") or "Untitled Story"
+    pages = story["pages"]
+    book_id = f"urn:uuid:{uuid.uuid5(uuid.NAMESPACE_URL, story['id'])}"
+    modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    manifest = ['<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>']
+    spine, nav_items = [], []
+    for page in pages:
+        n = page["page_number"]
+        manifest.append(f'<item id="page-{n}" href="page-{n}.xhtml" media-type="application/xhtml+xml"/>')
+        if n in images:
+            manifest.append(f'<item id="img-{n}" href="images/page-{n}.jpg" media-type="image/jpeg"/>')
+        spine.append(f'<itemref idref="page-{n}"/>')
+        nav_items.append(f'<li><a href="page-{n}.xhtml">Page {n}</a></li>')
+
+    content_opf = f"""<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier id="book-id">{book_id}</dc:identifier>
+<dc:title>{html.escape(title)}</dc:title>
+<dc:language>en</dc:language>
+<meta property="dcterms:modified">{modified}</meta>
+</metadata>
+<manifest>{"".join(manifest)}</manifest>
+<spine>{"".join(spine)}</spine>
+</package>"""
+
+    nav = f"""<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>{html.escape(title)}</title></head>
+<body><nav epub:type="toc"><h1>{html.escape(title)}</h1><ol>{"".join(nav_items)}</ol></nav></body>
+</html>"""
+
+    container = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w") as epub:
+        # The mimetype entry must come first and be stored uncompressed
+        epub.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        epub.writestr("META-INF/container.xml", container, compress_type=zipfile.ZIP_DEFLATED)
+        epub.writestr("OEBPS/content.opf", content_opf, compress_type=zipfile.ZIP_DEFLATED)
+        epub.writestr("OEBPS/nav.xhtml", nav, compress_type=zipfile.ZIP_DEFLATED)
+        for page in pages:
+            n = page["page_number"]
+            epub.writestr(f"OEBPS/page-{n}.xhtml", _page_xhtml(title, page, n in images), compress_type=zipfile.ZIP_DEFLATED)
+            if n in images:
+                # JPEGs are already compressed
+                epub.writestr(f"OEBPS/images/page-{n}.jpg", images[n], compress_type=zipfile.ZIP_STORED)
+    return out.getvalue()
+
+def _build_pdf(story: dict, images: dict[int, bytes]) -> bytes:
+    font = ImageFont.load_default(size=PDF_TEXT_FONT_SIZE)
+    line_height = int(PDF_TEXT_FONT_SIZE * 1.4)
+    margin = 48
+    width = IMAGE_MAX_SIZE
+
+    sheets = []
+    for page in story["pages"]:
+        lines = textwrap.wrap(page.get("text_content", ""), width=56) or [""]
+        illustration = Image.open(io.BytesIO(images[page["page_number"]])) if page["page_number"] in images else None
+        image_height = illustration.height if illustration else 0
+
+        sheet = Image.new("RGB", (width, image_height + margin * 2 + line_height * len(lines)), "white")
+        if illustration:
+            sheet.paste(illustration, ((width - illustration.width) // 2, 0))
+        draw = ImageDraw.Draw(sheet)
+        for i, line in enumerate(lines):
+            draw.text((margin, image_height + margin + i * line_height), line, fill="black", font=font)
+        sheets.append(sheet)
+
+    out = io.BytesIO()
+    sheets[0].save(
+        out, format="PDF", save_all=True, append_images=sheets[1:], resolution=150,
+        title=story.get("title") or "Untitled Story"
+    )
+    return out.getvalue()
+
+def render_bundle(story: dict, raw_images: dict[int, bytes]) -> tuple[dict[str, bytes], list[int]]:
+    """
+    Builds every export format for a story. Runs in the render process pool.
+    Returns the artifacts and the page numbers that made it in with an illustration.
+    """
+    images = {}
+    for page_number, image_bytes in raw_images.items():
+        optimized = _optimize_image(image_bytes)
+        if optimized:
+            images[page_number] = optimized
+
+    # Point pages at the bundled images so the archive works offline
+    pages = [
+        dict(page, image_file=f"images/page-{page['page_number']}.jpg") if page["page_number"] in images else page
+        for page in story["pages"]
+    ]
+    story_json = json.dumps(
+        {"id": story.get("id"), "title": story.get("title"), "creation_metadata": story.get("creation_metadata"), "pages": pages},
+        indent=2, default=str
+    )
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w") as bundle:
+        bundle.writestr("story.json", story_json, compress_type=zipfile.ZIP_DEFLATED)
+        for page_number, image_bytes in images.items():
+            bundle.writestr(f"images/page-{page_number}.jpg", image_bytes, compress_type=zipfile.ZIP_STORED)
+
+    artifacts = {
+        "zip": out.getvalue(),
+        "epub": _build_epub(story, images),
+        "pdf": _build_pdf(story, images),
+    }
+    return artifacts, sorted(images)
+
+# --- EXPORT STAGE (runs on the export thread) ---
+
+def _read_image(url: str) -> bytes | None:
+    if not url:
+        return None
+    try:
+        # Our own assets are read straight from the storage backend, never over HTTP
+        data = read_file_bytes(url)
+        if data is None:
+            # Not issued by this backend (placeholder art, assets from a previous backend)
+            response = requests.get(url, timeout=IMAGE_FETCH_TIMEOUT)
+            response.raise_for_status()
+            data = response.content
+        return data
+    except Exception as e:
+        print(f"⚠️ Export could not read {url}: {e}")
+        return None
+
+def _set_job_status(story_id: str, status: str, error: str = None):
+    # Dotted fields keep the attempt count
+    update_story_fields(story_id, {
+        "export_job.status": status,
+        "export_job.error": error,
+        "export_job.updated_at": datetime.now(timezone.utc),
+    })
+
+def _delete_superseded(previous: dict, current: dict):
+    """Removes the files of the bundle this render replaced, so re-renders don't pile up"""
+    for fmt in EXPORT_FORMATS:
+        url = previous.get(fmt)
+        if url and url != current.get(fmt):
+            try:
+                delete_file(url)
+            except Exception as e:
+                print(f"⚠️ Could not delete superseded export {url}: {e}")
+
+def export_story(story_id: str):
+    """
+    Renders and uploads the bundle. The previous bundle in `exports` stays downloadable
+    until the new one is uploaded, and is kept if the re-render fails.
+    """
+    if _stopping.is_set():
+        # Left queued in Mongo; picked up again on the next startup
+        return
+    story = get_story(story_id)
+    if not story or story.get("status") != "completed" or not story.get("pages"):
+        return
+    start_export_attempt(story_id)
+    try:
+        pages = story["pages"]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as reader:
+            fetched = dict(zip(
+                [p["page_number"] for p in pages],
+                reader.map(_read_image, [p.get("image_url") for p in pages])
+            ))
+        raw_images = {n: data for n, data in fetched.items() if data}
+        if not raw_images:
+            raise Exception("No page illustrations could be read")
+
+        # Only what the renderer needs crosses the process boundary
+        payload = {k: story.get(k) for k in ("id", "title", "creation_metadata", "pages")}
+        artifacts, illustrated = render_pool.get().submit(render_bundle, payload, raw_images).result()
+        missing = [p["page_number"] for p in pages if p["page_number"] not in illustrated]
+
+        exports = {
+            "status": "partial" if missing else "ready",
+            "missing_images": missing,
+            "bytes": {},
+            "rendered_at": datetime.now(timezone.utc),
+        }
+        # A new name per render: the previous bundle stays intact until `exports` points at this one
+        version = exports["rendered_at"].strftime("%Y%m%d%H%M%S%f")
+        for fmt, data in artifacts.items():
+            exports[fmt] = upload_file_bytes(
+                file_name=f"exports/{story_id}-{version}.{fmt}",
+                file_bytes=data,
+                content_type=EXPORT_FORMATS[fmt]
+            )
+            exports["bytes"][fmt] = len(data)
+        update_story_fields(story_id, {"exports": exports})
+        _set_job_status(story_id, "done")
+        _delete_superseded(story.get("exports") or {}, exports)
+        if missing:
+            print(f"⚠️ Exported story {story_id} without illustrations for pages {missing}")
+        print(f"📦 Exported story {story_id}: {exports['bytes']}")
+    except Exception as e:
+        if _stopping.is_set():
+            # Interrupted by shutdown, not a real failure: resumed on the next startup
+            print(f"⏸️ Export of story {story_id} interrupted by shutdown")
+            return
+        print(f"⚠️ Export failed for story {story_id}: {e}")
+        _set_job_status(story_id, "failed", str(e))
+
+def _enqueue(story_id: str):
+    try:
+        _export_queue.submit(export_story, story_id)
+    except RuntimeError:
+        # Shutting down: stays queued in Mongo until the next startup
+        pass
+
+def schedule_export(story_id: str):
+    """Queues a story for export without blocking the caller (new content: the attempt count starts over)"""
+    update_story_fields(story_id, {"export_job": {"status": "queued", "attempts": 0, "updated_at": datetime.now(timezone.utc)}})
+    _enqueue(story_id)
+
+def _resume_pending_exports():
+    resumed = 0
+    for story_id in iter_pending_exports(MAX_EXPORT_ATTEMPTS):
+        _enqueue(story_id)
+        resumed += 1
+    if resumed:
+        print(f"📦 Resuming {resumed} pending exports")
+
+def resume_pending_exports():
+    """
+    Re-queues exports lost with the previous process (queued, or interrupted mid-render).
+    Failed exports are left alone, and stories from before exports existed are handled by
+    the backfill script (python export.py). The lookup itself runs on the export thread.
+    """
+    _export_queue.submit(_resume_pending_exports)
+
+def stop_exports():
+    """Drops queued work without marking it failed; export_job keeps it resumable"""
+    _stopping.set()
+    _export_queue.shutdown(wait=False, cancel_futures=True)
+    render_pool.reset()
+
+if __name__ == "__main__":
+    # Backfill: render bundles for completed stories from before exports existed, a page at a time
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Render offline bundles for stories that never had one.")
+    parser.add_argument("--limit", type=int, default=0, help="Stop after this many stories (0 = all)")
+    parser.add_argument("--page-size", type=int, default=100)
+    args = parser.parse_args()
+
+    done, last_id = 0, None
+    try:
+        while not args.limit or done < args.limit:
+            story_ids = get_stories_without_exports(last_id, args.page_size)
+            if not story_ids:
+                break
+            for story_id in story_ids:
+                if args.limit and done >= args.limit:
+                    break
+                export_story(story_id)
+                done += 1
+            last_id = story_ids[-1]
+    finally:
+        render_pool.reset()
+    print(f"Exported {done} stories.")
@@ -12,12 +12,38 @@ GOOGLE_APP_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "creds.json
 ENVIRONMENT= os.getenv("ENVIRONMENT", "development")
 AZ_BLOB_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
 AZ_BLOB_CONTAINER_NAME = os.getenv("AZURE_STORAGE_CONTAINER_NAME", "storytellingprojbucket")
+
+# Asset storage (see storage.py): "azure" | "s3" | "local"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "azure").lower()
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "data/assets")
+LOCAL_STORAGE_PUBLIC_URL = os.getenv("LOCAL_STORAGE_PUBLIC_URL", "http://localhost:8000")
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # For S3-compatible stores (MinIO, R2...); credentials use the usual AWS_* vars
+S3_REGION = os.getenv("S3_REGION")
+S3_PUBLIC_URL = os.getenv("S3_PUBLIC_URL")
 ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 
-# Download Google vertex Json
-response = requests.get(JSON_URL)
-if response.status_code == 200:
-    os.makedirs(os.path.dirname(GOOGLE_APP_CREDENTIALS), exist_ok=True)
-    with open(GOOGLE_APP_CREDENTIALS, "w") as file:
-        json_f = response.json()
-        json.dump(json_f, file)
\ No newline at end of file
+# Model tiering (see model_router.py)
+MODEL_PRO = os.getenv("MODEL_PRO", "gemini-3-pro-preview")
+MODEL_FLASH = os.getenv("MODEL_FLASH", "gemini-3-flash-preview")
+ROUTER_PRO_MAX_ACTIVE_STORIES = int(os.getenv("ROUTER_PRO_MAX_ACTIVE_STORIES", "8"))
+ROUTER_PRO_LATENCY_BUDGET_SECONDS = float(os.getenv("ROUTER_PRO_LATENCY_BUDGET_SECONDS", "45"))
+
+# Similar-story search (see story_index.py)
+STORY_INDEX_DIR = os.getenv("STORY_INDEX_DIR", "data/story_index")
+
+# Idle-time pre-generation (see pregeneration.py). A budget of 0 disables it.
+PREGEN_DAILY_CALL_BUDGET = int(os.getenv("PREGEN_DAILY_CALL_BUDGET", "0"))
+PREGEN_TOP_COMBOS = int(os.getenv("PREGEN_TOP_COMBOS", "4"))
+PREGEN_STOCK_PER_COMBO = int(os.getenv("PREGEN_STOCK_PER_COMBO", "2"))
+PREGEN_ASSET_TTL_HOURS = float(os.getenv("PREGEN_ASSET_TTL_HOURS", "24"))
+PREGEN_IDLE_SECONDS = float(os.getenv("PREGEN_IDLE_SECONDS", "60"))
+
+# Download Google vertex Json (skipped when running against fake backends, e.g. loadtest.py)
+if JSON_URL:
+    response = requests.get(JSON_URL)
+    if response.status_code == 200:
+        os.makedirs(os.path.dirname(GOOGLE_APP_CREDENTIALS), exist_ok=True)
+        with open(GOOGLE_APP_CREDENTIALS, "w") as file:
+            json_f = response.json()
+            json.dump(json_f, file)
\ No newline at end of file
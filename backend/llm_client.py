@@ -127,7 +127,7 @@ class VertexAIClient:
                     return None
         return None
     
-    def generate_content_with_audio(self, audio_bytes: bytes, prompt: str, mime_type: str = "audio/webm") -> str:
+    def generate_content_with_audio(self, audio_bytes: bytes, prompt: str, mime_type: str = "audio/webm", model: str = "gemini-3-flash-preview") -> str:
         """
         Sends audio bytes directly (Inline) to Vertex AI.
         Avoids 'files.upload' error and works perfectly for files < 20MB.
@@ -147,7 +147,7 @@ class VertexAIClient:
 
             # 3. Single "Super-Call"
             response = self.client.models.generate_content(
-                model="gemini-3-flash-preview",
+                model=model,
                 contents=[
                     types.Content(
                         role="user",
@@ -0,0 +1,559 @@
+"""
+API-level load & soak test harness.
+
+Drives the real FastAPI `app` from main.py (served by uvicorn in-process) with
+simulated users:
+- Creators posting to /api/create/text and /api/create/audio
+- Viewers polling /api/story/{id} on the frontend's 2-second interval
+- History browsers hitting /api/history
+
+Model calls and blob uploads are replaced with fakes that sleep for a
+configurable latency, so only the backend itself (event loop, threadpool and
+MongoDB) is under test. Point MONGO_URI at a local, disposable Mongo.
+
+Usage:
+    MONGO_URI=mongodb://localhost:27017 python loadtest.py --stages 5,10,20,40 --stage-seconds 60
+
+Requires httpx (pip install httpx).
+"""
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import asyncio
+import argparse
+import threading
+import tempfile
+import subprocess
+from collections import defaultdict
+
+import numpy as np
+from PIL import Image
+
+from pymongo import monitoring
+
+POLL_INTERVAL_SECONDS = 2.0  # Matches the frontend's setInterval in story/[id]/page.tsx
+
+# --- FAKE BACKENDS ---
+
+def _build_fake_png(size: int = 512) -> bytes:
+    """A real (if plain) PNG, so exports decode and re-encode it like a generated image"""
+    out = io.BytesIO()
+    Image.new("RGB", (size, size), (120, 170, 220)).save(out, format="PNG")
+    return out.getvalue()
+
+FAKE_PNG = _build_fake_png()
+
+class FakeGeneratedImage:
+    def __init__(self, image_bytes: bytes):
+        self.image_bytes = image_bytes
+
+class FakeVertexAIClient:
+    """
+    Stand-in for llm_client.VertexAIClient.
+    Blocks the calling thread for a configurable time, like the real SDK does.
+    """
+    text_latency = 1.0
+    image_latency = 3.0
+    audio_latency = 2.0
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.calls[name] += 1
+
+    def _sleep(self, base: float):
+        time.sleep(max(0.0, random.uniform(0.5, 1.5) * base))
+
+    def _analysis(self) -> str:
+        return json.dumps({
+            "title": f"Load Test Story {random.randint(0, 1_000_000)}",
+            "plot_summary": "A tiny robot learns to share. Everyone has a picnic.",
+            "moral_lesson": "Sharing is caring",
+            "art_style": "whimsical watercolor",
+            "character_desc": "A tiny blue robot",
+            "visual_signature": "tiny blue robot with rusty antenna",
+            "setting_signature": "sunny meadow",
+        })
+
+    def _storyboard(self, prompt: str) -> str:
+        page_count = 8 if "Create a 8-page" in prompt else 5
+        return json.dumps([
+            {
+                "page_number": i + 1,
+                "text_content": "The tiny robot rolled through the meadow and waved at a bird. " * 2,
+                "image_prompt_description": f"whimsical watercolor of tiny blue robot, scene {i + 1}",
+            }
+            for i in range(page_count)
+        ])
+
+    def chat_completion(self, messages: list[dict], model: str = "gemini-3-flash-preview", **kwargs) -> str:
+        self._count(f"chat_completion:{model}")
+        self._sleep(self.text_latency)
+        prompt = str(messages[-1]["content"])
+        if "Storyboard Artist" in prompt:
+            return self._storyboard(prompt)
+        if "revising one page" in prompt:
+            return "The tiny robot shared its shiny bolts with a new friend."
+        return self._analysis()
+
+    def _rewrite_prompt_for_safety(self, unsafe_prompt: str, previous_failures: list[str] = []) -> str:
+        self._count("rewrite")
+        self._sleep(self.text_latency)
+        return unsafe_prompt
+
+    def generate_image(self, prompt: str, retries: int = 3):
+        self._count("generate_image")
+        self._sleep(self.image_latency)
+        return FakeGeneratedImage(FAKE_PNG)
+
+    def generate_content_with_audio(self, audio_bytes: bytes, prompt: str, mime_type: str = "audio/webm",
+                                    model: str = "gemini-3-flash-preview") -> str:
+        self._count(f"generate_content_with_audio:{model}")
+        self._sleep(self.audio_latency)
+        return self._analysis()
+
+    def embed_text(self, text: str, model: str = "text-embedding-004") -> list[float]:
+        self._count("embed_text")
+        return [random.random() for _ in range(768)]
+
+class FakeBlobStore:
+    """Stand-in for utils.upload_file_bytes / read_file_bytes / delete_file"""
+    latency = 0.2
+
+    def __init__(self):
+        self.uploads = 0
+        self.bytes_uploaded = 0
+        self.images = {}  # Only images are read back (by exports); everything else is just counted
+        self._lock = threading.Lock()
+
+    def upload_file_bytes(self, file_name, file_bytes, content_type="image/png"):
+        time.sleep(self.latency)
+        with self._lock:
+            self.uploads += 1
+            self.bytes_uploaded += len(file_bytes)
+            url = f"https://fake-blob.local/{file_name or self.uploads}"
+            if content_type.startswith("image/"):
+                self.images[url] = file_bytes
+        return url
+
+    def delete_file(self, url):
+        with self._lock:
+            self.images.pop(url, None)
+
+    def read_file_bytes(self, url):
+        time.sleep(self.latency)
+        with self._lock:
+            if url not in self.images:
+                raise FileNotFoundError(url)
+            return self.images[url]
+
+def build_audio_clip(seconds: float) -> tuple[bytes, str]:
+    """
+    A synthetic "voice note" shaped like a browser recording: 48kHz stereo Opus in WebM,
+    with leading/trailing silence and long pauses, so /api/create/audio exercises the real
+    decode/trim/encode path. Falls back to random bytes (which ffmpeg rejects) without ffmpeg.
+    """
+    if shutil.which("ffmpeg") is None:
+        print("⚠️ ffmpeg not found: audio uploads are random bytes and skip preprocessing.")
+        return os.urandom(int(seconds * 16 * 1024)), "audio/webm"
+
+    rate = 48000
+    rng = np.random.default_rng(0)
+    samples = np.zeros(int(seconds * rate), dtype=np.float32)
+    t = 0.8  # Leading silence
+    while t < seconds - 1.0:
+        # A "phrase" of syllable-like harmonic bursts, then a pause
+        for _ in range(rng.integers(3, 8)):
+            length = rng.uniform(0.12, 0.3)
+            n = int(length * rate)
+            start = int(t * rate)
+            if start + n > len(samples) - rate:
+                break
+            ts = np.arange(n) / rate
+            pitch = rng.uniform(110, 220)
+            burst = sum(np.sin(2 * np.pi * pitch * h * ts) / h for h in (1, 2, 3))
+            samples[start:start + n] = 0.3 * burst * np.hanning(n)
+            t += length + rng.uniform(0.03, 0.1)
+        t += rng.uniform(0.4, 1.6)
+
+    result = subprocess.run(
+        [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-f", "f32le", "-ar", str(rate), "-ac", "1", "-i", "pipe:0",
+            "-ac", "2", "-c:a", "libopus", "-b:a", "96k", "-f", "webm", "pipe:1",
+        ],
+        input=samples.tobytes(), capture_output=True, check=True,
+    )
+    return result.stdout, "audio/webm"
+
+# --- MONITORS ---
+
+class MongoListener(monitoring.CommandListener):
+    def __init__(self):
+        self.ops = defaultdict(int)
+        self.failures = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        with self._lock:
+            self.ops[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        with self._lock:
+            self.failures[event.command_name] += 1
+
+    def snapshot(self) -> tuple[dict, dict]:
+        with self._lock:
+            return dict(self.ops), dict(self.failures)
+
+class ServerMonitor:
+    """
+    Runs inside the server's event loop and samples:
+    - Event-loop lag (how late a short sleep wakes up)
+    - Threadpool saturation (anyio's default limiter, used for sync endpoints and BackgroundTasks)
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lags = []
+        self.pool_samples = []
+
+    async def run(self):
+        import anyio.to_thread
+
+        loop = asyncio.get_running_loop()
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - start - self.interval))
+            self.pool_samples.append(
+                (limiter.borrowed_tokens, limiter.total_tokens, limiter.statistics().tasks_waiting)
+            )
+
+    def drain(self) -> tuple[list, list]:
+        lags, self.lags = self.lags, []
+        pool_samples, self.pool_samples = self.pool_samples, []
+        return lags, pool_samples
+
+def start_server(app, monitor: ServerMonitor, host: str, port: int):
+    """Serves the app with uvicorn on a background thread (own event loop)"""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+
+    async def serve():
+        monitor_task = asyncio.create_task(monitor.run())
+        try:
+            await server.serve()
+        finally:
+            monitor_task.cancel()
+
+    thread = threading.Thread(target=lambda: asyncio.run(serve()), daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("Server failed to start")
+        time.sleep(0.05)
+    return server, thread
+
+# --- LOAD GENERATION ---
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+class LoadStats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.stories_finished = defaultdict(int)
+
+    def record(self, endpoint: str, seconds: float, ok: bool):
+        self.latencies[endpoint].append(seconds)
+        if not ok:
+            self.errors[endpoint] += 1
+
+class LoadRunner:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.stats = LoadStats()
+        self.story_ids = []
+        self.audio_clip, self.audio_mime_type = build_audio_clip(args.audio_seconds)
+
+    async def _request(self, method: str, url: str, endpoint: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            ok = response.status_code < 400
+        except Exception:
+            response, ok = None, False
+        self.stats.record(endpoint, time.perf_counter() - start, ok)
+        return response if ok else None
+
+    async def _create(self) -> str | None:
+        theme = random.choice(["Fun", "Bedtime", "Adventure", "Friendship"])
+        maturity = random.choice(["toddler", "child", "youth"])
+        if random.random() < self.args.audio_ratio:
+            response = await self._request(
+                "POST", "/api/create/audio", "POST /api/create/audio",
+                files={"file": ("recording.webm", self.audio_clip, self.audio_mime_type)},
+                data={"theme": theme, "maturity": maturity},
+                # Every upload is the same clip: a fresh key keeps dedup from collapsing them
+                headers={"Idempotency-Key": uuid.uuid4().hex},
+            )
+        else:
+            response = await self._request(
+                "POST", "/api/create/text", "POST /api/create/text",
+                json={"prompt_text": f"A tiny robot who learns to share #{random.randint(0, 10**9)}", "theme": theme, "maturity": maturity},
+            )
+        if response is None:
+            return None
+        story_id = response.json()["id"]
+        self.story_ids.append(story_id)
+        return story_id
+
+    async def _poll(self, story_id: str, deadline: float) -> str | None:
+        """Polls like the story page does, until the story settles or the stage ends"""
+        while time.monotonic() < deadline:
+            response = await self._request("GET", f"/api/story/{story_id}", "GET /api/story/{id}")
+            if response is not None:
+                status = response.json().get("status")
+                if status in ("completed", "failed"):
+                    return status
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+        return None
+
+    async def creator(self, deadline: float):
+        await asyncio.sleep(random.uniform(0, POLL_INTERVAL_SECONDS))
+        while time.monotonic() < deadline:
+            story_id = await self._create()
+            if story_id:
+                # The frontend redirects the creator to the story page, which starts polling
+                status = await self._poll(story_id, deadline)
+                if status:
+                    self.stats.stories_finished[status] += 1
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.args.creator_think)
+
+    async def viewer(self, deadline: float):
+        await asyncio.sleep(random.uniform(0, POLL_INTERVAL_SECONDS))
+        while time.monotonic() < deadline:
+            if not self.story_ids:
+                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+                continue
+            await self._poll(random.choice(self.story_ids[-50:]), deadline)
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+    async def browser(self, deadline: float):
+        await asyncio.sleep(random.uniform(0, POLL_INTERVAL_SECONDS))
+        while time.monotonic() < deadline:
+            await self._request("GET", "/api/history", "GET /api/history")
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.args.history_think)
+
+    async def run_stage(self, users: int):
+        self.stats = LoadStats()
+        creators = max(1, round(users * self.args.creator_ratio))
+        browsers = max(1, round(users * self.args.history_ratio))
+        viewers = max(0, users - creators - browsers)
+        deadline = time.monotonic() + self.args.stage_seconds
+        await asyncio.gather(
+            *[self.creator(deadline) for _ in range(creators)],
+            *[self.viewer(deadline) for _ in range(viewers)],
+            *[self.browser(deadline) for _ in range(browsers)],
+        )
+        return {"creators": creators, "viewers": viewers, "browsers": browsers}
+
+# --- REPORTING ---
+
+def build_stage_report(stage: int, users: int, mix: dict, runner: LoadRunner, monitor: ServerMonitor,
+                       mongo_delta: tuple[dict, dict], args) -> dict:
+    duration = args.stage_seconds
+    endpoints = {}
+    for endpoint, latencies in sorted(runner.stats.latencies.items()):
+        errors = runner.stats.errors.get(endpoint, 0)
+        endpoints[endpoint] = {
+            "requests": len(latencies),
+            "rps": round(len(latencies) / duration, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            "error_rate": round(errors / len(latencies), 4) if latencies else 0.0,
+        }
+
+    lags, pool_samples = monitor.drain()
+    mongo_ops, mongo_failures = mongo_delta
+    report = {
+        "stage": stage,
+        "users": users,
+        "mix": mix,
+        "endpoints": endpoints,
+        "event_loop_lag_ms": {
+            "p99": round(percentile(lags, 99) * 1000, 1),
+            "max": round(max(lags, default=0.0) * 1000, 1),
+        },
+        "threadpool": {
+            "max_busy": max((s[0] for s in pool_samples), default=0),
+            "size": pool_samples[-1][1] if pool_samples else 0,
+            "max_waiting": max((s[2] for s in pool_samples), default=0),
+        },
+        "mongo_ops_per_sec": {name: round(count / duration, 1) for name, count in sorted(mongo_ops.items())},
+        "mongo_failures": mongo_failures,
+        "stories_finished": dict(runner.stats.stories_finished),
+    }
+    report["breached"] = any(
+        e["p95_ms"] > args.slo_p95_ms or e["error_rate"] > args.max_error_rate for e in endpoints.values()
+    )
+    return report
+
+def print_stage_report(report: dict):
+    print(f"\n=== Stage {report['stage']}: {report['users']} users {report['mix']} ===")
+    for endpoint, e in report["endpoints"].items():
+        print(
+            f"  {endpoint:<26} n={e['requests']:<6} rps={e['rps']:<7} "
+            f"p50={e['p50_ms']}ms p95={e['p95_ms']}ms p99={e['p99_ms']}ms err={e['error_rate']:.2%}"
+        )
+    pool = report["threadpool"]
+    print(f"  event loop lag  p99={report['event_loop_lag_ms']['p99']}ms max={report['event_loop_lag_ms']['max']}ms")
+    print(f"  threadpool      busy<={pool['max_busy']}/{pool['size']} waiting<={pool['max_waiting']}")
+    print(f"  mongo ops/sec   {report['mongo_ops_per_sec']} failures={report['mongo_failures']}")
+    print(f"  stories         {report['stories_finished']}")
+    if report["breached"]:
+        print("  ❌ SLO breached")
+
+def diff_counts(after: dict, before: dict) -> dict:
+    return {k: v - before.get(k, 0) for k, v in after.items() if v - before.get(k, 0)}
+
+async def run_load(args, monitor: ServerMonitor, mongo_listener: MongoListener) -> tuple[list[dict], list[str]]:
+    import httpx
+
+    base_url = f"http://{args.host}:{args.port}"
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        runner = LoadRunner(client, args)
+        reports = []
+        for stage, users in enumerate(args.stages, start=1):
+            monitor.drain()
+            ops_before, failures_before = mongo_listener.snapshot()
+            mix = await runner.run_stage(users)
+            ops_after, failures_after = mongo_listener.snapshot()
+            report = build_stage_report(
+                stage, users, mix, runner, monitor,
+                (diff_counts(ops_after, ops_before), diff_counts(failures_after, failures_before)),
+                args,
+            )
+            print_stage_report(report)
+            reports.append(report)
+        return reports, runner.story_ids
+
+def cleanup(story_ids: list[str]):
+    from database import stories_collection, story_pages_collection, story_context_collection
+
+    stories_collection.delete_many({"_id": {"$in": story_ids}})
+    story_pages_collection.delete_many({"story_id": {"$in": story_ids}})
+    story_context_collection.delete_many({"_id": {"$in": story_ids}})
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load/soak test the storyteller API against fake model backends.")
+    parser.add_argument("--stages", default="5,10,20,40,80", help="Comma-separated concurrent users per ramp stage")
+    parser.add_argument("--stage-seconds", type=float, default=60)
+    parser.add_argument("--creator-ratio", type=float, default=0.2, help="Share of users that create stories")
+    parser.add_argument("--history-ratio", type=float, default=0.1, help="Share of users browsing history")
+    parser.add_argument("--audio-ratio", type=float, default=0.3, help="Share of creations that upload audio")
+    parser.add_argument("--audio-seconds", type=float, default=20, help="Length of the synthetic voice note")
+    parser.add_argument("--creator-think", type=float, default=10, help="Seconds between a creator's stories")
+    parser.add_argument("--history-think", type=float, default=5, help="Seconds between history loads")
+    parser.add_argument("--text-latency", type=float, default=FakeVertexAIClient.text_latency)
+    parser.add_argument("--image-latency", type=float, default=FakeVertexAIClient.image_latency)
+    parser.add_argument("--audio-latency", type=float, default=FakeVertexAIClient.audio_latency)
+    parser.add_argument("--blob-latency", type=float, default=FakeBlobStore.latency)
+    parser.add_argument("--slo-p95-ms", type=float, default=500, help="p95 latency that marks the break point")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--fail-before-stage", type=int, default=0,
+                        help="Exit non-zero if the SLO breaks at or before this stage (capacity regression guard)")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--json", dest="json_path", help="Write the stage reports to this file")
+    parser.add_argument("--cleanup", action="store_true", help="Delete the stories created by this run")
+    args = parser.parse_args(argv)
+    args.stages = [int(s) for s in args.stages.split(",") if s.strip()]
+    return args
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    FakeVertexAIClient.text_latency = args.text_latency
+    FakeVertexAIClient.image_latency = args.image_latency
+    FakeVertexAIClient.audio_latency = args.audio_latency
+    FakeBlobStore.latency = args.blob_latency
+
+    # Listeners must be registered before database.py creates its MongoClient
+    mongo_listener = MongoListener()
+    monitoring.register(mongo_listener)
+
+    # Fake stories get random embeddings: keep them out of the real similar-story index
+    index_dir = tempfile.mkdtemp(prefix="loadtest-story-index-")
+    os.environ["STORY_INDEX_DIR"] = index_dir
+
+    # Swap in the fakes before the app modules instantiate their clients
+    import llm_client
+    llm_client.VertexAIClient = FakeVertexAIClient
+
+    import main as api
+    import orchestrator
+    import export
+
+    blob_store = FakeBlobStore()
+    api.upload_file_bytes = blob_store.upload_file_bytes
+    orchestrator.upload_file_bytes = blob_store.upload_file_bytes
+    export.upload_file_bytes = blob_store.upload_file_bytes
+    export.read_file_bytes = blob_store.read_file_bytes
+    export.delete_file = blob_store.delete_file
+
+    monitor = ServerMonitor()
+    server, thread = start_server(api.app, monitor, args.host, args.port)
+    try:
+        reports, story_ids = asyncio.run(run_load(args, monitor, mongo_listener))
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+
+    print(f"\nModel calls: {dict(orchestrator.vertex_client.calls)}")
+    print(f"Model router: {orchestrator.model_router.snapshot()}")
+    print(f"Blob uploads: {blob_store.uploads} ({blob_store.bytes_uploaded / 1e6:.1f} MB)")
+
+    break_point = next((r for r in reports if r["breached"]), None)
+    if break_point:
+        print(f"Break point: stage {break_point['stage']} ({break_point['users']} users)")
+    else:
+        print("No SLO breach at the tested load.")
+
+    if args.json_path:
+        with open(args.json_path, "w") as file:
+            json.dump({"args": vars(args), "stages": reports}, file, indent=2, default=str)
+
+    if args.cleanup:
+        cleanup(story_ids)
+    shutil.rmtree(index_dir, ignore_errors=True)
+
+    if args.fail_before_stage and break_point and break_point["stage"] <= args.fail_before_stage:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
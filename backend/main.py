@@ -1,13 +1,25 @@
-from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse, FileResponse, RedirectResponse
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import json
 import uuid
+import os
 from init_env import ENVIRONMENT
 
-from models import StoryInput, StoryResponse, StoryStatus
-from database import save_story, get_story, get_all_stories
-from orchestrator import generate_story_task
+from models import StoryInput, StoryResponse, StoryStatus, PageRegenerateInput
+from database import save_story, get_story, get_all_stories, get_stories_by_ids, ensure_indexes, release_fingerprint, get_story_fields, get_page
+from orchestrator import (
+    generate_story_task, regenerate_page_image, regenerate_page_text, PageNotFound, vertex_client, pregeneration
+)
+from story_index import get_story_index
+from storage import get_storage, LocalStorage, MEDIA_TYPES
+from export import EXPORT_FORMATS, resume_pending_exports, stop_exports
 from utils import upload_file_bytes
+from audio_processing import preprocess_audio_async
+from single_flight import fingerprint_request, find_or_claim, get_stats as get_dedup_stats
 
 app = FastAPI(title="Gemini Storyteller Agent",
               description="An API to generate children's stories using Gemini LLMs.",
@@ -22,24 +34,66 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def create_indexes():
+    ensure_indexes()
+
+@app.on_event("startup")
+def start_pregeneration():
+    pregeneration.start()
+
+@app.on_event("shutdown")
+def stop_pregeneration():
+    pregeneration.stop()
+
+@app.on_event("startup")
+def resume_exports():
+    # The export queue is in memory: pick up whatever the previous process left behind (non-blocking)
+    resume_pending_exports()
+
+@app.on_event("shutdown")
+def stop_export_queue():
+    stop_exports()
+
 @app.post("/api/create/text", response_model=StoryResponse)
-async def create_story_text(input_data: StoryInput, background_tasks: BackgroundTasks):
+async def create_story_text(
+    input_data: StoryInput,
+    background_tasks: BackgroundTasks,
+    idempotency_key: str | None = Header(None)
+):
     story_id = str(uuid.uuid4())
+
+    # Identical request already running? Attach to it instead of paying for a second pipeline
+    fingerprint = fingerprint_request(
+        input_data.theme, input_data.maturity.value, prompt_text=input_data.prompt_text,
+        idempotency_key=idempotency_key
+    )
+    duplicate = find_or_claim(fingerprint, story_id)
+    if duplicate:
+        return duplicate
+
+    metadata = input_data.dict()
+    metadata["fingerprint"] = fingerprint
     
     # Initialize DB entry
     new_story = {
         "id": story_id,
-        "creation_metadata": input_data.dict(),
+        "creation_metadata": metadata,
         "status": StoryStatus.QUEUED,
         "progress": 0,
         "current_stage_message": "Queued...",
         "creation_process_context": {},
         "pages": []
     }
-    save_story(story_id, new_story)
+    try:
+        save_story(story_id, new_story)
+    except Exception:
+        # Otherwise identical requests would attach to a story that was never written
+        release_fingerprint(fingerprint, story_id)
+        raise
     
     # Start Agent in Background
-    background_tasks.add_task(generate_story_task, story_id, input_data.dict(), None)
+    background_tasks.add_task(generate_story_task, story_id, metadata, None)
     
     return new_story
 
@@ -48,39 +102,63 @@ async def create_story_audio(
     background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     theme: str = Form("Fun"),
-    maturity: str = Form("toddler")
+    maturity: str = Form("toddler"),
+    priority: str = Form("normal"),
+    idempotency_key: str | None = Header(None)
 ):
     story_id = str(uuid.uuid4())
     
     # Read audio bytes
     audio_bytes = await file.read()
 
-    audio_url = upload_file_bytes(
-        file_name=None,
-        file_bytes=audio_bytes,
-        content_type=file.content_type
-    )
-    
     if len(audio_bytes) == 0:
         raise HTTPException(status_code=400, detail="Audio file is empty")
-    
-    input_data = {
-        "theme": theme,
-        "maturity": maturity,
-        "prompt_text": "Audio Input",
-        "audio_url": audio_url
-    }
 
-    new_story = {
-        "id": story_id,
-        "status": StoryStatus.QUEUED,
-        "creation_metadata": input_data,
-        "progress": 0,
-        "current_stage_message": "Processing audio...",
-        "creation_process_context": {},
-        "pages": []
-    }
-    save_story(story_id, new_story)
+    # Dedup on the raw upload, before spending any preprocessing/upload time
+    fingerprint = fingerprint_request(theme, maturity, audio_bytes=audio_bytes, idempotency_key=idempotency_key)
+    duplicate = find_or_claim(fingerprint, story_id)
+    if duplicate:
+        return duplicate
+
+    try:
+        # Trim silence, downmix & compress (process pool) so both the model and storage get the small file
+        processed = await preprocess_audio_async(audio_bytes, file.content_type or "audio/webm")
+        audio_bytes = processed["audio_bytes"]
+        audio_stats = {k: v for k, v in processed.items() if k != "audio_bytes"}
+        audio_stats["bytes_saved"] = audio_stats["original_bytes"] - audio_stats["processed_bytes"]
+        print(f"🎤 Audio for {story_id}: {audio_stats['original_bytes']} -> {audio_stats['processed_bytes']} bytes")
+
+        audio_url = upload_file_bytes(
+            file_name=None,
+            file_bytes=audio_bytes,
+            content_type=processed["mime_type"]
+        )
+
+        input_data = {
+            "theme": theme,
+            "maturity": maturity,
+            "prompt_text": "Audio Input",
+            "priority": priority,
+            "fingerprint": fingerprint,
+            "audio_url": audio_url,
+            "audio_mime_type": processed["mime_type"],
+            "audio_preprocessing": audio_stats
+        }
+
+        new_story = {
+            "id": story_id,
+            "status": StoryStatus.QUEUED,
+            "creation_metadata": input_data,
+            "progress": 0,
+            "current_stage_message": "Processing audio...",
+            "creation_process_context": {},
+            "pages": []
+        }
+        save_story(story_id, new_story)
+    except Exception:
+        # Let a retry of this exact upload start fresh
+        release_fingerprint(fingerprint, story_id)
+        raise
     
     # Start Agent
     background_tasks.add_task(generate_story_task, story_id, input_data, audio_bytes)
@@ -92,10 +170,146 @@ async def get_story_status(story_id: str):
     story = get_story(story_id)
     if not story:
         return {"id": story_id, "status": "failed", "progress": 0, "current_stage_message": "Not found", "pages": []}
-    if 'creation_process_context' in story:
-        del story['creation_process_context']
     return story
 
+def _stream_page_regeneration(task, story_id: str, page_number: int, input_data: PageRegenerateInput | None):
+    """
+    Runs a page regeneration in the threadpool and streams its progress as NDJSON.
+    The work continues (and the page is still updated) if the client disconnects.
+    """
+    story = get_story_fields(story_id, "status", "creation_metadata")
+    if not story:
+        raise HTTPException(status_code=404, detail="Story not found")
+    if story.get("status") not in (StoryStatus.COMPLETED, StoryStatus.FAILED):
+        raise HTTPException(status_code=409, detail="Story is still being generated")
+    if get_page(story_id, page_number) is None:
+        raise HTTPException(status_code=404, detail=f"Page {page_number} not found")
+
+    maturity = (story.get("creation_metadata") or {}).get("maturity", "toddler")
+    instructions = input_data.instructions if input_data else None
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def on_progress(message: str):
+        loop.call_soon_threadsafe(events.put_nowait, {"stage": "progress", "message": message})
+
+    async def run():
+        try:
+            page = await run_in_threadpool(task, story_id, page_number, maturity, instructions, on_progress)
+            await events.put({"stage": "completed", "message": f"Page {page_number} updated.", "page": page})
+        except PageNotFound as e:
+            await events.put({"stage": "failed", "message": str(e)})
+        except Exception as e:
+            print(f"Page regeneration failed for {story_id} page {page_number}: {e}")
+            await events.put({"stage": "failed", "message": f"Error: {str(e)}"})
+
+    worker = asyncio.create_task(run())
+
+    async def stream():
+        while True:
+            event = await events.get()
+            yield json.dumps(event, default=str) + "\n"
+            if event["stage"] in ("completed", "failed"):
+                break
+        await worker
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.post("/api/story/{story_id}/pages/{page_number}/regenerate")
+async def regenerate_page(story_id: str, page_number: int, input_data: PageRegenerateInput | None = None):
+    """Re-illustrates a single page (one image call), streaming progress as NDJSON"""
+    return _stream_page_regeneration(regenerate_page_image, story_id, page_number, input_data)
+
+@app.post("/api/story/{story_id}/pages/{page_number}/regenerate/text")
+async def regenerate_page_text_only(story_id: str, page_number: int, input_data: PageRegenerateInput | None = None):
+    """Rewrites a single page's text, keeping its illustration"""
+    return _stream_page_regeneration(regenerate_page_text, story_id, page_number, input_data)
+
+def _search_cards(index, vector, k: int, exclude: tuple = ()) -> list[dict]:
+    """Index search + card lookup. Blocking (matmul over the memmap, Mongo read): run in the threadpool."""
+    try:
+        results = index.search(vector, k, exclude=exclude)
+    except ValueError as e:
+        # Index built with a different embedding model
+        raise HTTPException(status_code=503, detail=f"Story index unavailable: {e}")
+    stories = {s["id"]: s for s in get_stories_by_ids([story_id for story_id, _ in results])}
+    return [dict(stories[story_id], score=round(score, 4)) for story_id, score in results if story_id in stories]
+
+@app.get("/api/stories/search")
+async def search_stories(q: str = Query(..., min_length=1), k: int = Query(10, ge=1, le=100)):
+    """Top-k stories by cosine similarity to the query text"""
+    vector = await run_in_threadpool(vertex_client.embed_text, q)
+    if not vector:
+        raise HTTPException(status_code=503, detail="Embedding service unavailable")
+    return await run_in_threadpool(_search_cards, get_story_index(), vector, k)
+
+@app.get("/api/story/{story_id}/similar")
+async def similar_stories(story_id: str, k: int = Query(5, ge=1, le=100)):
+    """Stories closest to this one, using its stored embedding (no model call)"""
+    index = get_story_index()
+    vector = index.vector_for(story_id)
+    if vector is None:
+        raise HTTPException(status_code=404, detail="Story is not indexed yet")
+    return await run_in_threadpool(_search_cards, index, vector, k, (story_id,))
+
+@app.get("/api/assets/{name}")
+async def get_asset(name: str):
+    """
+    Serves assets from the local storage backend.
+    Names are content hashes, so responses are cached forever; FileResponse handles
+    Range requests and uses the server's zero-copy path (ASGI pathsend) where available.
+    """
+    storage = get_storage()
+    path = storage.path_for(name) if isinstance(storage, LocalStorage) else None
+    if not path or not await run_in_threadpool(os.path.exists, path):
+        raise HTTPException(status_code=404, detail="Asset not found")
+    return FileResponse(
+        path,
+        media_type=MEDIA_TYPES.get(name.rsplit(".", 1)[-1]),
+        headers={"Cache-Control": "public, max-age=31536000, immutable"}
+    )
+
+@app.get("/api/story/{story_id}/export/{fmt}")
+async def download_export(story_id: str, fmt: str):
+    """
+    Downloads the offline bundle (zip | epub | pdf) rendered after completion.
+    exports.status is "partial" when some illustrations couldn't be included (see exports.missing_images).
+    Local storage is served directly (Range + ETag); remote backends redirect to the stored object.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=404, detail=f"Unknown export format '{fmt}'")
+    story = get_story_fields(story_id, "title", "exports", "export_job")
+    if not story:
+        raise HTTPException(status_code=404, detail="Story not found")
+    # The last good bundle stays downloadable while a re-render runs (or after it fails)
+    exports = story.get("exports") or {}
+    if not exports.get(fmt):
+        job = story.get("export_job") or {}
+        raise HTTPException(status_code=404, detail=f"Export not ready (status: {job.get('status', 'not scheduled')})")
+
+    url = exports[fmt]
+    storage = get_storage()
+    if isinstance(storage, LocalStorage):
+        path = storage.path_for(url.rsplit("/", 1)[-1])
+        if path and await run_in_threadpool(os.path.exists, path):
+            return FileResponse(
+                path,
+                media_type=EXPORT_FORMATS[fmt],
+                filename=f"{story.get('title') or 'story'}.{fmt}",
+                # The bundle can be re-rendered after a page fix, so let clients revalidate via ETag
+                headers={"Cache-Control": "public, max-age=3600"}
+            )
+    return RedirectResponse(url, status_code=307)
+
+@app.get("/api/stats/dedup")
+async def get_dedup_metrics():
+    return get_dedup_stats()
+
+@app.get("/api/stats/pregeneration")
+async def get_pregeneration_report():
+    """Hit rate / waste of idle-time pre-generation, to judge whether the spend is worth it"""
+    return await run_in_threadpool(pregeneration.report)
+
 @app.get("/api/history")
 async def get_history():
     # Convert dict to list
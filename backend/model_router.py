@@ -0,0 +1,116 @@
+import time
+import threading
+from contextlib import contextmanager
+from init_env import (
+    MODEL_PRO, MODEL_FLASH, ROUTER_PRO_MAX_ACTIVE_STORIES, ROUTER_PRO_LATENCY_BUDGET_SECONDS
+)
+
+TIERS = {
+    "pro": MODEL_PRO,
+    "flash": MODEL_FLASH,
+}
+
+# Which tier each stage wants when there is headroom
+STAGE_PREFERENCES = {
+    "narrative_analysis": "pro",
+    "audio_analysis": "flash",
+    "storyboarding": "flash",
+    "page_rewrite": "flash",
+}
+
+# Older readers get longer, more nuanced storyboards, worth the premium model when it's cheap to do so
+MATURITY_UPGRADES = {
+    ("storyboarding", "youth"): "pro",
+}
+
+EWMA_ALPHA = 0.2
+# Without pro traffic the latency estimate can't recover, so stale samples are ignored (acts as a probe)
+LATENCY_STALE_SECONDS = 120
+
+class ModelRouter:
+    """
+    Picks a model per stage from:
+    - Load: number of stories currently being generated
+    - Observed latency: EWMA of recent calls per model
+    - The request's priority ("low" | "normal" | "high")
+    - Maturity level
+    Pro falls back to flash under pressure; flash is never upgraded past its stage preference.
+    """
+
+    def __init__(self, max_active_stories: int = ROUTER_PRO_MAX_ACTIVE_STORIES,
+                 latency_budget: float = ROUTER_PRO_LATENCY_BUDGET_SECONDS):
+        self.max_active_stories = max_active_stories
+        self.latency_budget = latency_budget
+        self.active_stories = 0
+        self.in_flight = {model: 0 for model in TIERS.values()}
+        self.latency_ewma = {}
+        self.latency_updated_at = {}
+        self.served = {tier: 0 for tier in TIERS}
+        self._lock = threading.Lock()
+
+    # --- Load tracking ---
+
+    def story_started(self):
+        with self._lock:
+            self.active_stories += 1
+
+    def story_finished(self):
+        with self._lock:
+            self.active_stories = max(0, self.active_stories - 1)
+
+    @contextmanager
+    def track(self, model: str):
+        """Wrap a model call to record in-flight count and latency"""
+        with self._lock:
+            self.in_flight[model] = self.in_flight.get(model, 0) + 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self.in_flight[model] -= 1
+                previous = self.latency_ewma.get(model)
+                self.latency_ewma[model] = elapsed if previous is None else (
+                    EWMA_ALPHA * elapsed + (1 - EWMA_ALPHA) * previous
+                )
+                self.latency_updated_at[model] = time.monotonic()
+
+    # --- Routing ---
+
+    def _pro_has_headroom(self, pressure_factor: float = 1.0) -> bool:
+        latency = self.latency_ewma.get(TIERS["pro"])
+        if time.monotonic() - self.latency_updated_at.get(TIERS["pro"], 0) > LATENCY_STALE_SECONDS:
+            latency = None
+        return (
+            self.active_stories <= self.max_active_stories * pressure_factor
+            and (latency is None or latency <= self.latency_budget * pressure_factor)
+        )
+
+    def choose_tier(self, stage: str, priority: str = "normal", maturity: str = None) -> str:
+        preferred = MATURITY_UPGRADES.get((stage, maturity), STAGE_PREFERENCES.get(stage, "flash"))
+        if preferred == "flash" or priority == "low":
+            return "flash"
+
+        with self._lock:
+            # High priority keeps pro until we're well past the normal limits
+            pressure_factor = 2.0 if priority == "high" else 1.0
+            return "pro" if self._pro_has_headroom(pressure_factor) else "flash"
+
+    def choose(self, stage: str, priority: str = "normal", maturity: str = None) -> tuple[str, str]:
+        """Returns (tier, model_name)"""
+        tier = self.choose_tier(stage, priority, maturity)
+        with self._lock:
+            self.served[tier] += 1
+        return tier, TIERS[tier]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "active_stories": self.active_stories,
+                "in_flight": dict(self.in_flight),
+                "latency_ewma_seconds": {m: round(v, 2) for m, v in self.latency_ewma.items()},
+                "served": dict(self.served),
+            }
+
+model_router = ModelRouter()
@@ -20,6 +20,7 @@ class StoryInput(BaseModel):
     prompt_text: Optional[str] = None
     theme: str = "Fun"
     maturity: MaturityLevel = MaturityLevel.TODDLER
+    priority: Literal["low", "normal", "high"] = "normal"  # Drives model tiering under load
 
 class Page(BaseModel):
     page_number: int
@@ -30,6 +31,10 @@ class Page(BaseModel):
     audio_url: Optional[str] = None 
 
 
+class PageRegenerateInput(BaseModel):
+    # Optional steer for the new version, e.g. "make it night time"
+    instructions: Optional[str] = None
+
 class StoryStatus(str, Enum):
     QUEUED = "queued"
     ANALYZING = "analyzing_narrative"
@@ -46,4 +51,8 @@ class StoryResponse(BaseModel):
     creation_metadata: Optional[dict] = None
     status_history: Optional[List[StatusLog]] = None
     title: Optional[str] = None
+    model_tiers: Optional[dict] = None  # Stage -> tier that served it, e.g. {"narrative_analysis": "pro"}
+    pregenerated: Optional[bool] = None # Narrative analysis started from a pre-generated scaffold
+    exports: Optional[dict] = None      # Last good offline bundle, e.g. {"status": "ready", "zip": "..."}
+    export_job: Optional[dict] = None   # Current (re-)render, e.g. {"status": "rendering"}
     pages: List[Page] = []
\ No newline at end of file
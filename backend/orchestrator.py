@@ -1,16 +1,30 @@
 import json
 import os
+import time
 from google.genai import types 
 from llm_client import VertexAIClient
-from database import update_status, save_story, get_story
-from PROMPTS import get_narrative_analysis_system_prompt, get_storyboard_prompt
+from database import (
+    update_status, update_story_fields, save_pages, save_context, release_fingerprint,
+    get_context, get_page, get_pages, update_page, append_status_log
+)
+from PROMPTS import get_narrative_analysis_system_prompt, get_storyboard_prompt, get_page_text_rewrite_prompt
 import math
 from utils import upload_file_bytes
+from model_router import model_router
+from story_index import index_story
+from pregeneration import PregenerationService
+from export import schedule_export
 import concurrent.futures
 
 # Initialize the client once
 vertex_client = VertexAIClient()
 
+FALLBACK_IMAGE_URL = "https://placehold.co/1024x1024/EEE/31343C.png?text=Illustration+Unavailable&font=lora"
+ERROR_IMAGE_URL = "https://via.placeholder.com/512?text=Error"
+
+# Idle-time pre-generation for popular theme/maturity pairs (started from main.py)
+pregeneration = PregenerationService(vertex_client)
+
 def process_single_page_task(page_data, metadata={}) -> dict:
     """
     1. Generates Image
@@ -19,6 +33,8 @@ def process_single_page_task(page_data, metadata={}) -> dict:
     """
     maturity = metadata.get("maturity", "toddler")
     story_id = metadata.get("story_id", "unknown")
+    # Progress goes to the story status by default; page regeneration passes its own sink
+    notify = metadata.get("on_progress") or (lambda message: update_status(story_id, "illustrating", -1, message))
     max_retries = 4
     attempt = 0
     current_prompt = page_data['image_prompt_description']
@@ -47,10 +63,7 @@ def process_single_page_task(page_data, metadata={}) -> dict:
                 
                 # If we succeeded after a rewrite, update status to let user know we fixed it
                 if attempt > 0:
-                     update_status(
-                        story_id, "illustrating", -1, 
-                        f"✅ Fixed Page {page_data['page_number']} after {attempt} retries."
-                    )
+                    notify(f"✅ Fixed Page {page_data['page_number']} after {attempt} retries.")
                 break # Exit Loop
 
             else:
@@ -61,8 +74,7 @@ def process_single_page_task(page_data, metadata={}) -> dict:
                 
                 if attempt < max_retries:
                     # Notify User
-                    update_status(
-                        story_id, "illustrating", -1,
+                    notify(
                         f"⚠️ Safety block (Page {page_data['page_number']}). AI is rewriting prompt (Try {attempt}/{max_retries})..."
                     )
                     
@@ -78,7 +90,7 @@ def process_single_page_task(page_data, metadata={}) -> dict:
         # B. Fallback if Loop ends without success
         if not final_image_url:
             print(f"⚠️ Using fallback image for Page {page_data['page_number']}")
-            final_image_url = "https://placehold.co/1024x1024/EEE/31343C.png?text=Illustration+Unavailable&font=lora"
+            final_image_url = FALLBACK_IMAGE_URL
 
         return {
             "page_number": page_data['page_number'],
@@ -95,7 +107,7 @@ def process_single_page_task(page_data, metadata={}) -> dict:
         return {
             "page_number": page_data['page_number'],
             "text_content": page_data['text_content'],
-            "image_url": "https://via.placeholder.com/512?text=Error", # Fallback
+            "image_url": ERROR_IMAGE_URL, # Fallback
             "image_prompt": current_prompt,
             "success": False
         }
@@ -121,35 +133,67 @@ def generate_story_task(story_id: str, input_data: dict, audio_file_bytes: bytes
     """
     The Main Orchestrator Loop (Synchronous).
     """
+    priority = input_data.get("priority", "normal")
+    model_tiers = {}
+    started_at = time.monotonic()
+    model_router.story_started()
     try:
         # --- STAGE 1: ANALYZING NARRATIVE ---
+        audio_stats = input_data.get("audio_preprocessing") or {}
+        if audio_stats.get("preprocessed"):
+            update_status(
+                story_id, "analyzing_narrative", 5,
+                f"Cleaned up recording: {audio_stats['original_seconds']}s -> {audio_stats['processed_seconds']}s, "
+                f"saved {audio_stats['bytes_saved'] // 1024} KB."
+            )
         update_status(story_id, "analyzing_narrative", 10, "Listening to story and extracting themes...")
+
+        # Pre-generated art direction for popular presets, if any is in stock.
+        # Text requests only, so hit/miss timings compare like with like (audio is a separate flash-only path)
+        pregen_lookup = pregeneration.enabled and not audio_file_bytes
+        pregenerated = pregeneration.take(input_data['theme'], input_data['maturity']) if pregen_lookup else None
+        scaffold = pregenerated["scaffold"] if pregenerated else None
+        if pregenerated:
+            update_story_fields(story_id, {"pregenerated": True})
         
         # Get Prompt from PROMPTS.py
         system_prompt_str = get_narrative_analysis_system_prompt(
             maturity=input_data['maturity'],
             theme=input_data['theme'],
-            audio_type = True if audio_file_bytes else False
+            audio_type = True if audio_file_bytes else False,
+            scaffold=scaffold
         )
         
         messages = []
         if audio_file_bytes:
-            transcript = vertex_client.generate_content_with_audio(
-                audio_bytes=audio_file_bytes,
-                prompt="Transcribe the audio exactly."
-            )
+            audio_mime_type = input_data.get("audio_mime_type", "audio/webm")
+            tier, model = model_router.choose("audio_analysis", priority, input_data['maturity'])
+            model_tiers["narrative_analysis"] = tier
+            with model_router.track(model):
+                transcript = vertex_client.generate_content_with_audio(
+                    audio_bytes=audio_file_bytes,
+                    prompt="Transcribe the audio exactly.",
+                    mime_type=audio_mime_type,
+                    model=model
+                )
             user_content = f"{system_prompt_str}\n\nHere is the transcript:\n{transcript}"
-            response_text = vertex_client.generate_content_with_audio(
-                audio_bytes=audio_file_bytes,
-                prompt=system_prompt_str
-            )
+            with model_router.track(model):
+                response_text = vertex_client.generate_content_with_audio(
+                    audio_bytes=audio_file_bytes,
+                    prompt=system_prompt_str,
+                    mime_type=audio_mime_type,
+                    model=model
+                )
         else:
             # Text Input
             user_content = f"{system_prompt_str}\n\nStory Concept: {input_data['prompt_text']}"
             messages.append({"role": "user", "content": user_content})
 
             # Call LLM (Force JSON output via prompt instructions + low temp)
-            response_text = vertex_client.chat_completion(messages, temperature=0.4, model="gemini-3-pro-preview")
+            tier, model = model_router.choose("narrative_analysis", priority, input_data['maturity'])
+            model_tiers["narrative_analysis"] = tier
+            with model_router.track(model):
+                response_text = vertex_client.chat_completion(messages, temperature=0.4, model=model)
 
         if 'error' in response_text and type(response_text) == dict:
             raise Exception("LLM Generation Failed during Narrative Analysis")
@@ -158,12 +202,14 @@ def generate_story_task(story_id: str, input_data: dict, audio_file_bytes: bytes
         # Clean & Parse JSON
         clean_json = response_text.replace("```json", "").replace("```", "").strip()
         analysis = json.loads(clean_json)
+        if scaffold and scaffold.get("art_style"):
+            analysis["art_style"] = scaffold["art_style"]
+        if pregen_lookup:
+            pregeneration.record_timing(bool(pregenerated), "analysis", time.monotonic() - started_at)
         
         # Save Metadata
-        story = get_story(story_id)
-        story["title"] = analysis.get("title", "Untitled Story")
-        story["creation_process_context"]["narrative_analysis"] = analysis
-        save_story(story_id, story)
+        update_story_fields(story_id, {"title": analysis.get("title", "Untitled Story"), "model_tiers": model_tiers})
+        save_context(story_id, narrative_analysis=analysis)
 
         # --- STAGE 2: STORYBOARDING ---
         update_status(story_id, "storyboarding", 30, "Splitting story into pages...")
@@ -173,10 +219,14 @@ def generate_story_task(story_id: str, input_data: dict, audio_file_bytes: bytes
         # Get Prompt from PROMPTS.py
         sb_prompt_str = get_storyboard_prompt(page_count, analysis)
         
-        sb_response_text = vertex_client.chat_completion(
-            [{"role": "user", "content": sb_prompt_str}], 
-            temperature=0.7
-        )
+        tier, model = model_router.choose("storyboarding", priority, input_data['maturity'])
+        model_tiers["storyboarding"] = tier
+        with model_router.track(model):
+            sb_response_text = vertex_client.chat_completion(
+                [{"role": "user", "content": sb_prompt_str}], 
+                temperature=0.7,
+                model=model
+            )
         if 'error' in sb_response_text and type(sb_response_text) == dict:
             raise Exception("LLM Generation Failed during Storyboarding")
         
@@ -226,14 +276,93 @@ def generate_story_task(story_id: str, input_data: dict, audio_file_bytes: bytes
         
 
         # --- FINISH ---
-        story = get_story(story_id)
-        story["pages"] = final_pages
-        story["creation_process_context"]["storyboard_pages"] = pages_data
-        save_story(story_id, story)
+        save_pages(story_id, final_pages)
+        save_context(story_id, storyboard_pages=pages_data)
+        update_story_fields(story_id, {"model_tiers": model_tiers})
         update_status(story_id, "completed", 100, "Story ready!")
+        if pregen_lookup:
+            pregeneration.record_timing(bool(pregenerated), "ready", time.monotonic() - started_at)
+
+        # Embed once for similar-story search; never fails the story
+        try:
+            index_story(story_id, analysis.get("title"), analysis.get("plot_summary"), input_data['theme'], vertex_client.embed_text)
+        except Exception as e:
+            print(f"⚠️ Could not index story {story_id}: {e}")
+
+        # Offline bundle (zip/EPUB/PDF) is rendered on its own queue, after the story is already live
+        schedule_export(story_id)
 
     except Exception as e:
         print(f"CRITICAL ERROR in orchestrator: {e}")
         import traceback
         traceback.print_exc()
-        update_status(story_id, "failed", 0, f"Error: {str(e)}")
\ No newline at end of file
+        update_status(story_id, "failed", 0, f"Error: {str(e)}")
+    finally:
+        model_router.story_finished()
+        if input_data.get("fingerprint"):
+            # Identical requests from now on start a fresh job
+            release_fingerprint(input_data["fingerprint"], story_id)
+
+# --- PAGE REGENERATION ---
+
+class PageNotFound(Exception):
+    pass
+
+def _load_page_context(story_id: str, page_number: int):
+    page = get_page(story_id, page_number)
+    if page is None:
+        raise PageNotFound(f"Page {page_number} not found for story {story_id}")
+    context = get_context(story_id, "narrative_analysis", "storyboard_pages")
+    return page, context.get("narrative_analysis") or {}, context.get("storyboard_pages") or []
+
+def regenerate_page_image(story_id: str, page_number: int, maturity: str = "toddler",
+                          instructions: str = None, on_progress=None) -> dict:
+    """
+    Re-illustrates one page from the stored Story Bible + storyboard: a single image call.
+    Keeps the existing image if generation falls back to a placeholder.
+    """
+    notify = on_progress or (lambda message: None)
+    page, analysis, storyboard = _load_page_context(story_id, page_number)
+
+    sb_page = next((p for p in storyboard if p.get("page_number") == page_number), {})
+    prompt = sb_page.get("image_prompt_description") or page["image_prompt"]
+    visual_signature = analysis.get("visual_signature")
+    if visual_signature and visual_signature not in prompt:
+        prompt = f"{analysis.get('art_style', 'digital illustration')} style, {visual_signature}. {prompt}"
+    if instructions:
+        prompt = f"{prompt} {instructions}"
+
+    notify(f"Illustrating page {page_number}...")
+    result = process_single_page_task(
+        {"page_number": page_number, "text_content": page["text_content"], "image_prompt_description": prompt},
+        {"maturity": maturity, "story_id": story_id, "on_progress": notify}
+    )
+    if not result["success"] or result["image_url"] in (FALLBACK_IMAGE_URL, ERROR_IMAGE_URL):
+        raise Exception(f"Could not generate a new illustration for page {page_number}")
+
+    page.update({"image_url": result["image_url"], "image_prompt": result["image_prompt"], "success": True})
+    update_page(story_id, page)
+    append_status_log(story_id, f"🎨 Re-illustrated page {page_number}.")
+    schedule_export(story_id)
+    return page
+
+def regenerate_page_text(story_id: str, page_number: int, maturity: str = "toddler",
+                         instructions: str = None, on_progress=None) -> dict:
+    """Rewrites one page's text from the stored Story Bible, keeping its illustration"""
+    notify = on_progress or (lambda message: None)
+    page, analysis, _ = _load_page_context(story_id, page_number)
+    page_texts = [{"page_number": p["page_number"], "text_content": p["text_content"]} for p in get_pages(story_id)]
+
+    notify(f"Rewriting page {page_number}...")
+    prompt = get_page_text_rewrite_prompt(analysis, page_texts, page_number, instructions)
+    tier, model = model_router.choose("page_rewrite", maturity=maturity)
+    with model_router.track(model):
+        text = vertex_client.chat_completion([{"role": "user", "content": prompt}], temperature=0.7, model=model)
+    if isinstance(text, dict) or not text.strip():
+        raise Exception(f"LLM Generation Failed while rewriting page {page_number}")
+
+    page.update({"text_content": text.strip(), "duration": estimate_reading_time(text, maturity)})
+    update_page(story_id, page)
+    append_status_log(story_id, f"✏️ Rewrote page {page_number}.")
+    schedule_export(story_id)
+    return page
@@ -0,0 +1,173 @@
+import json
+import time
+import threading
+from datetime import datetime, timezone, timedelta
+from init_env import (
+    PREGEN_DAILY_CALL_BUDGET, PREGEN_TOP_COMBOS, PREGEN_STOCK_PER_COMBO,
+    PREGEN_ASSET_TTL_HOURS, PREGEN_IDLE_SECONDS
+)
+from database import (
+    get_popular_combos, count_pregen_assets, save_pregen_asset, take_pregen_asset,
+    expire_pregen_assets, spend_pregen_budget, get_pregen_spend, record_pregen_stats, get_pregen_stats
+)
+from model_router import model_router, TIERS
+from PROMPTS import get_story_bible_scaffold_prompt
+
+POLL_SECONDS = 10
+HISTORY_DAYS = 7
+CALLS_PER_ASSET = 1  # One scaffold call
+# Stages timed from story start for requests that looked up an asset, to compare hits with misses
+TIMED_STAGES = ("analysis", "ready")
+
+def combo_key(theme: str, maturity: str) -> str:
+    return f"{(theme or '').strip().lower()}|{(maturity or '').strip().lower()}"
+
+class PregenerationService:
+    """
+    Background worker that spends idle model capacity on popular (theme, maturity) pairs.
+
+    Each asset is a single-use Story Bible scaffold (art style, setting, mood) made by the
+    pro model. A matching request's narrative analysis takes the art style as decided and
+    doesn't generate it; the report compares hit and miss latency to show what that saves.
+    Spend is capped per UTC day; assets unused after PREGEN_ASSET_TTL_HOURS are counted as waste.
+    Spend and hit/miss/waste counters live in Mongo, so the report covers every worker and restart.
+    """
+
+    def __init__(self, vertex_client, daily_call_budget: int = PREGEN_DAILY_CALL_BUDGET):
+        self.vertex_client = vertex_client
+        self.daily_call_budget = daily_call_budget
+        self.idle_since = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.daily_call_budget > 0
+
+    def start(self):
+        if not self.enabled or self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name="pregeneration", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(POLL_SECONDS):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"⚠️ Pre-generation cycle failed: {e}")
+
+    # --- Producing ---
+
+    def _is_idle(self) -> bool:
+        if model_router.active_stories > 0:
+            self.idle_since = None
+            return False
+        if self.idle_since is None:
+            self.idle_since = time.monotonic()
+        return time.monotonic() - self.idle_since >= PREGEN_IDLE_SECONDS
+
+    def _today(self) -> str:
+        return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+    def run_once(self):
+        now = datetime.now(timezone.utc)
+        wasted = expire_pregen_assets(now - timedelta(hours=PREGEN_ASSET_TTL_HOURS))
+        if wasted:
+            record_pregen_stats(self._today(), {"wasted": wasted})
+
+        if not self._is_idle():
+            return
+        for combo in get_popular_combos(now - timedelta(days=HISTORY_DAYS), PREGEN_TOP_COMBOS):
+            key = combo_key(combo["theme"], combo["maturity"])
+            while count_pregen_assets(key) < PREGEN_STOCK_PER_COMBO:
+                # Re-check between assets: real traffic always wins
+                if not self._is_idle() or self._stop.is_set():
+                    return
+                if get_pregen_spend(self._today()) + CALLS_PER_ASSET > self.daily_call_budget:
+                    return
+                self._generate(key, combo["theme"], combo["maturity"])
+
+    def _generate(self, key: str, theme: str, maturity: str):
+        spend_pregen_budget(self._today(), CALLS_PER_ASSET)
+
+        model = TIERS["pro"]
+        with model_router.track(model):
+            response_text = self.vertex_client.chat_completion(
+                [{"role": "user", "content": get_story_bible_scaffold_prompt(theme, maturity)}],
+                temperature=0.9,
+                model=model
+            )
+        if isinstance(response_text, dict):
+            raise Exception("LLM Generation Failed during scaffold pre-generation")
+        scaffold = json.loads(response_text.replace("```json", "").replace("```", "").strip())
+
+        save_pregen_asset(key, {"theme": theme, "maturity": maturity, "scaffold": scaffold})
+        record_pregen_stats(self._today(), {"generated": 1})
+        print(f"🔮 Pre-generated assets for {key}")
+
+    # --- Consuming ---
+
+    def take(self, theme: str, maturity: str):
+        """Returns a pre-generated asset for this request, or None"""
+        if not self.enabled:
+            return None
+        key = combo_key(theme, maturity)
+        asset = take_pregen_asset(key)
+        # Mongo field names can't contain dots
+        counts = {"hits": 1, f"hits_by_combo.{key.replace('.', '_')}": 1} if asset else {"misses": 1}
+        record_pregen_stats(self._today(), counts)
+        return asset
+
+    def record_timing(self, hit: bool, stage: str, seconds: float):
+        """Seconds from story start to `stage` for a request that looked up an asset"""
+        group = "hit" if hit else "miss"
+        record_pregen_stats(self._today(), {
+            f"timings.{group}.{stage}_seconds": seconds,
+            f"timings.{group}.{stage}_count": 1,
+        })
+
+    def report(self) -> dict:
+        stats = {"hits": 0, "misses": 0, "generated": 0, "wasted": 0}
+        hits_by_combo = {}
+        timings = {"hit": {}, "miss": {}}
+        calls_spent_today = 0
+        for day in get_pregen_stats():
+            for name in stats:
+                stats[name] += day.get(name, 0)
+            for key, hits in (day.get("hits_by_combo") or {}).items():
+                hits_by_combo[key] = hits_by_combo.get(key, 0) + hits
+            for group, values in (day.get("timings") or {}).items():
+                for name, value in values.items():
+                    timings[group][name] = timings[group].get(name, 0) + value
+            if day["_id"] == self._today():
+                calls_spent_today = day.get("calls", 0)
+        latency = {}
+        for stage in TIMED_STAGES:
+            averages = {}
+            for group, values in timings.items():
+                count = values.get(f"{stage}_count", 0)
+                averages[group] = round(values.get(f"{stage}_seconds", 0) / count, 2) if count else None
+            latency[stage] = {
+                "hit_avg_seconds": averages["hit"],
+                "miss_avg_seconds": averages["miss"],
+                "saved_seconds": (
+                    round(averages["miss"] - averages["hit"], 2)
+                    if averages["hit"] is not None and averages["miss"] is not None else None
+                ),
+            }
+
+        lookups = stats["hits"] + stats["misses"]
+        return {
+            "enabled": self.enabled,
+            "daily_call_budget": self.daily_call_budget,
+            "calls_spent_today": calls_spent_today,
+            **stats,
+            "hit_rate": round(stats["hits"] / lookups, 4) if lookups else 0.0,
+            "waste_rate": round(stats["wasted"] / stats["generated"], 4) if stats["generated"] else 0.0,
+            "hits_by_combo": hits_by_combo,
+            "latency": latency,
+        }
@@ -0,0 +1,31 @@
+import threading
+import multiprocessing
+import concurrent.futures
+
+class LazyProcessPool:
+    """
+    A process pool for CPU-bound work (audio preprocessing, export rendering), created on first use.
+
+    Workers start from a forkserver: forking the running server would copy locks held by
+    its Mongo/anyio threads, and a worker could deadlock on them.
+    """
+
+    def __init__(self, max_workers: int = 2):
+        self.max_workers = max_workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def get(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("forkserver")
+                )
+            return self._pool
+
+    def reset(self):
+        """Drops the pool (e.g. after a worker died); the next get() builds a fresh one"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,53 @@
+import re
+import hashlib
+from database import claim_fingerprint, get_story, increment_counters, get_counters
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", (text or "").strip().lower())
+
+def fingerprint_request(theme: str, maturity: str, prompt_text: str = None,
+                        audio_bytes: bytes = None, idempotency_key: str = None) -> str:
+    """
+    Stable fingerprint of a story request.
+    Text prompts are normalized (case/whitespace), audio is hashed by content.
+    An idempotency key scopes the fingerprint, so distinct keys never collapse together.
+    """
+    parts = [
+        _normalize(theme),
+        _normalize(maturity),
+        _normalize(prompt_text),
+        hashlib.sha256(audio_bytes).hexdigest() if audio_bytes else "",
+        idempotency_key or "",
+    ]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+def find_or_claim(fingerprint: str, story_id: str):
+    """
+    Claims the fingerprint for story_id.
+    Returns None if this request should start a new job, or the in-flight story
+    it duplicates (the caller should return that instead of starting another pipeline).
+    """
+    existing_id = claim_fingerprint(fingerprint, story_id)
+    existing = None
+    if existing_id:
+        existing = get_story(existing_id, include_pages=False)
+        if existing is None:
+            # The first request claimed but hasn't written its story yet
+            existing = {"id": existing_id, "status": "queued", "progress": 0,
+                        "current_stage_message": "Queued...", "pages": []}
+        elif existing["status"] in ("completed", "failed"):
+            # Stale claim (missed release): take it over
+            claim_fingerprint(fingerprint, story_id, force=True)
+            existing = None
+
+    # Counted in Mongo so the rate covers every worker and survives restarts
+    increment_counters("dedup", {"requests": 1, "duplicates": 1 if existing else 0})
+    if existing:
+        print(f"♻️ Duplicate request attached to in-flight story {existing_id}")
+    return existing
+
+def get_stats() -> dict:
+    counters = get_counters("dedup")
+    stats = {"requests": counters.get("requests", 0), "duplicates": counters.get("duplicates", 0)}
+    stats["duplicate_rate"] = round(stats["duplicates"] / stats["requests"], 4) if stats["requests"] else 0.0
+    return stats
@@ -0,0 +1,225 @@
+import os
+import re
+import hashlib
+import tempfile
+import mimetypes
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from urllib.parse import unquote
+from init_env import (
+    STORAGE_BACKEND, AZ_BLOB_CONNECTION_STRING, AZ_BLOB_CONTAINER_NAME,
+    LOCAL_STORAGE_DIR, LOCAL_STORAGE_PUBLIC_URL,
+    S3_BUCKET, S3_ENDPOINT_URL, S3_REGION, S3_PUBLIC_URL
+)
+
+# Content-addressed asset names served by the local backend: <sha256>.<ext>
+ASSET_NAME_PATTERN = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{1,8}$")
+
+# Explicit where the system mimetypes table is unreliable
+EXTENSIONS = {
+    "image/png": "png",
+    "audio/ogg": "ogg",    # Preprocessed recordings (mimetypes says .oga)
+    "audio/webm": "webm",  # Browser recordings stored as-is (unknown to mimetypes)
+    "application/zip": "zip",
+    "application/epub+zip": "epub",
+    "application/pdf": "pdf",
+}
+# ...and back, for serving local assets (mimetypes would call .webm video/webm)
+MEDIA_TYPES = {ext: content_type for content_type, ext in EXTENSIONS.items()}
+
+def _extension_for(content_type: str) -> str:
+    if content_type in EXTENSIONS:
+        return EXTENSIONS[content_type]
+    ext = mimetypes.guess_extension(content_type or "") or ".dat"
+    return ext.lstrip(".")
+
+def generate_file_name(content_type: str) -> str:
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}.{_extension_for(content_type)}"
+
+class StorageBackend(ABC):
+    """Stores generated/uploaded assets and returns a URL the frontend can load them from."""
+
+    @abstractmethod
+    def upload(self, file_name: str | None, file_bytes: bytes, content_type: str) -> str:
+        ...
+
+    @abstractmethod
+    def read(self, name: str) -> bytes:
+        ...
+
+    @abstractmethod
+    def delete(self, name: str):
+        """Removes a stored asset; missing assets are not an error"""
+        ...
+
+    @abstractmethod
+    def name_for_url(self, url: str) -> str | None:
+        """The stored name behind a URL this backend returned, or None for anyone else's URL"""
+        ...
+
+def _strip_prefix(url: str, prefix: str) -> str | None:
+    url = url.split("?", 1)[0]
+    return unquote(url[len(prefix):]) if url.startswith(prefix) else None
+
+class AzureBlobStorage(StorageBackend):
+    def __init__(self, connection_string: str = AZ_BLOB_CONNECTION_STRING, container_name: str = AZ_BLOB_CONTAINER_NAME):
+        from azure.storage.blob import BlobServiceClient
+
+        # Created once; the client keeps its connection pool between uploads
+        self.container_client = BlobServiceClient.from_connection_string(
+            connection_string
+        ).get_container_client(container_name)
+
+    def upload(self, file_name, file_bytes, content_type="image/png"):
+        from azure.storage.blob import ContentSettings
+
+        file_name = file_name or generate_file_name(content_type)
+        blob_client = self.container_client.get_blob_client(file_name)
+
+        # Explicitly delete if exists
+        if blob_client.exists():
+            blob_client.delete_blob()
+
+        content_settings = ContentSettings(
+            content_type=content_type,
+            content_disposition="inline",
+        )
+
+        blob_client.upload_blob(
+            file_bytes,
+            overwrite=True,
+            blob_type="BlockBlob",
+            content_settings=content_settings,
+            timeout=120,
+        )
+        return blob_client.url
+
+    def read(self, name):
+        return self.container_client.get_blob_client(name).download_blob(timeout=120).readall()
+
+    def delete(self, name):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            self.container_client.delete_blob(name)
+        except ResourceNotFoundError:
+            pass
+
+    def name_for_url(self, url):
+        return _strip_prefix(url, f"{self.container_client.url.rstrip('/')}/")
+
+class S3Storage(StorageBackend):
+    """Any S3-compatible store (AWS, MinIO, R2...). Needs `pip install boto3`."""
+
+    def __init__(self, bucket: str = S3_BUCKET, endpoint_url: str = S3_ENDPOINT_URL,
+                 region: str = S3_REGION, public_url: str = S3_PUBLIC_URL):
+        try:
+            import boto3
+        except ImportError as e:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires boto3 (pip install boto3)") from e
+
+        if not bucket:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires S3_BUCKET")
+        self.bucket = bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        if public_url:
+            self.public_url = public_url.rstrip("/")
+        elif endpoint_url:
+            self.public_url = f"{endpoint_url.rstrip('/')}/{bucket}"
+        else:
+            self.public_url = f"https://{bucket}.s3.amazonaws.com"
+
+    def upload(self, file_name, file_bytes, content_type="image/png"):
+        file_name = file_name or generate_file_name(content_type)
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=file_name,
+            Body=file_bytes,
+            ContentType=content_type,
+            ContentDisposition="inline",
+        )
+        return f"{self.public_url}/{file_name}"
+
+    def read(self, name):
+        return self.client.get_object(Bucket=self.bucket, Key=name)["Body"].read()
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def name_for_url(self, url):
+        return _strip_prefix(url, f"{self.public_url}/")
+
+class LocalStorage(StorageBackend):
+    """
+    Content-addressed files on local disk, served by the API itself (GET /api/assets/{name}).
+    Names are the SHA-256 of the bytes, so identical assets are stored once and URLs never change.
+    """
+
+    def __init__(self, root: str = LOCAL_STORAGE_DIR, public_url: str = LOCAL_STORAGE_PUBLIC_URL):
+        self.root = root
+        self.public_url = public_url.rstrip("/")
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, name: str) -> str | None:
+        """Filesystem path of an asset, or None for names that aren't ours"""
+        if not ASSET_NAME_PATTERN.match(name):
+            return None
+        return os.path.join(self.root, name[:2], name)
+
+    def upload(self, file_name, file_bytes, content_type="image/png"):
+        # file_name is ignored: the content decides the name
+        name = f"{hashlib.sha256(file_bytes).hexdigest()}.{_extension_for(content_type)}"
+        path = self.path_for(name)
+        if not os.path.exists(path):
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            # Write to a temp file in the same directory, then rename: readers never see partial files
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    file.write(file_bytes)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return f"{self.public_url}/api/assets/{name}"
+
+    def read(self, name):
+        path = self.path_for(name)
+        if path is None:
+            raise FileNotFoundError(name)
+        with open(path, "rb") as file:
+            return file.read()
+
+    def delete(self, name):
+        path = self.path_for(name)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def name_for_url(self, url):
+        # Matched on the path alone, so assets stay readable if LOCAL_STORAGE_PUBLIC_URL changes
+        path, _, name = url.split("?", 1)[0].rpartition("/")
+        return name if path.endswith("/api/assets") and self.path_for(name) else None
+
+BACKENDS = {
+    "azure": AzureBlobStorage,
+    "s3": S3Storage,
+    "local": LocalStorage,
+}
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage() -> StorageBackend:
+    """The backend selected by STORAGE_BACKEND, created on first use"""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            if STORAGE_BACKEND not in BACKENDS:
+                raise RuntimeError(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}', expected one of {list(BACKENDS)}")
+            _storage = BACKENDS[STORAGE_BACKEND]()
+        return _storage